@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+"""
+Time how long humbug takes to plan its work, on made-up pages and
+annexes of various sizes.
+
+Each phase is timed separately: reading the annex directories,
+parsing the page, working out which handler each download belongs to
+and where it goes, enqueueing the downloads, resolve_missing, and
+planning the final list of actions. Nothing is downloaded, and the
+run stops before anything would happen to the annex.
+
+Results are written as JSON, so that two commits can be compared
+with --compare.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import contextlib
+import platform
+import argparse
+import tempfile
+import subprocess
+import __builtin__
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synthetic
+from src.app import Humbug
+from src.humble_page import HumblePage
+from src.tree_index import TreeIndex
+from src.config import GAMES_SUBDIR, BOOKS_SUBDIR, MOVIES_SUBDIR, ALBUMS_SUBDIR
+
+# Where results go unless --output says otherwise. (Ignored by git.)
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+
+PHASES = ['scan', 'parse', 'classify', 'enqueue', 'resolve_missing', 'plan']
+DEFAULT_SIZES = [100, 1000, 10000, 50000]
+
+class Quiet(object):
+    """Throw away everything humbug prints while we're timing it."""
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *exc_info):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+@contextlib.contextmanager
+def timed(times, name):
+    """Time the body of a with statement into times[name]."""
+    start = time.time()
+    yield
+    times[name] = time.time() - start
+
+def humbug_args(page, options):
+    args = [page, '--parser', options.parser, '--no-hash-cache',
+            '--no-page-cache']
+    if options.compact:
+        args.append('--compact')
+    if options.stream:
+        args.append('--stream')
+    return args
+
+def classify(app, items):
+    """Run the handlers over items without enqueueing anything.
+
+    Returns the arguments they would have passed to enqueue, and the
+    number of items (which might have been a generator)."""
+    calls = []
+    count = 0
+    app.enqueue = lambda *args: calls.append(args)
+    for item in items:
+        count += 1
+        handler = app.handler_for(item)
+        if handler:
+            handler(app, item).handle()
+    del app.enqueue
+    return calls, count
+
+def build(workdir, size, options):
+    """Make a page and an annex to go with it, and go into the annex.
+
+    Returns (page filename, number of downloads, {layout: count})."""
+    page = os.path.join(workdir, 'home.html')
+    annex = os.path.join(workdir, 'annex')
+    offered = synthetic.make_page(page, size, options.per_item, options.seed)
+
+    # Work out where everything would go, so we know where to put
+    # the files that are already there.
+    os.chdir(workdir)
+    app = Humbug(humbug_args(page, options))
+    app.tree = TreeIndex([])
+    with Quiet():
+        calls = classify(app, HumblePage(app.config).iteritems())[0]
+    targets = [(target_dir, target_filename, dl.md5)
+               for handler, item, dl, target_dir, target_filename, unpack in calls]
+    counts = synthetic.make_annex(annex, targets, offered,
+                                  options.plain_size, options.seed)
+    os.chdir(annex)
+    return page, len(offered), counts
+
+def run_once(page, options):
+    """Plan the work for page, from scratch. Returns (phase times, stats)."""
+    times = {}
+    app = Humbug(humbug_args(page, options))
+    with Quiet():
+        with timed(times, 'scan'):
+            app.tree = TreeIndex([GAMES_SUBDIR, BOOKS_SUBDIR, MOVIES_SUBDIR,
+                                  ALBUMS_SUBDIR])
+        with timed(times, 'parse'):
+            page = HumblePage(app.config)
+            items = page.iteritems()
+        # (With --stream, most of the parsing happens in here, as the
+        # items are asked for.)
+        with timed(times, 'classify'):
+            calls, count = classify(app, items)
+        with timed(times, 'enqueue'):
+            for args in calls:
+                app.enqueue(*args)
+        with timed(times, 'resolve_missing'):
+            wont_do_queue, action_queue = app.resolve_missing()
+        with timed(times, 'plan'):
+            actions = app.display_actions(wont_do_queue, action_queue)
+        app.annex.close()
+    stats = {
+        'items': count,
+        'queued': sum(len(hdls) for hdls in app.download_queue.itervalues()),
+        'actions': len(actions),
+        'problem_dirs': len(wont_do_queue),
+    }
+    return times, stats
+
+def benchmark(size, options):
+    workdir = tempfile.mkdtemp(prefix='humbug-bench-')
+    cwd = os.getcwd()
+    try:
+        page, offered, layout = build(workdir, size, options)
+        best = {}
+        for i in range(options.repeat):
+            times, stats = run_once(page, options)
+            for phase, seconds in times.iteritems():
+                best[phase] = min(best.get(phase, seconds), seconds)
+        return {
+            'size': size,
+            'downloads': offered,
+            'layout': layout,
+            'stats': stats,
+            'seconds': best,
+            'total': sum(best.itervalues()),
+        }
+    finally:
+        os.chdir(cwd)
+        if options.keep:
+            print "Left files in", workdir
+        else:
+            shutil.rmtree(workdir)
+
+def git_describe():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'describe', '--always', '--dirty'],
+                cwd=ROOT, stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def report(result):
+    print "{:>7} downloads: {}  total {:.3f}s".format(
+        result['downloads'],
+        '  '.join('{} {:.3f}s'.format(phase, result['seconds'][phase])
+                  for phase in PHASES),
+        result['total'])
+
+def compare(old_filename, new_filename):
+    with open(old_filename) as f:
+        old = json.load(f)
+    with open(new_filename) as f:
+        new = json.load(f)
+    print "{} -> {}".format(old['commit'], new['commit'])
+    old_results = dict((result['size'], result) for result in old['results'])
+    for result in new['results']:
+        if result['size'] not in old_results:
+            continue
+        before = old_results[result['size']]
+        changes = []
+        for phase in PHASES + ['total']:
+            if phase == 'total':
+                then, now = before['total'], result['total']
+            else:
+                then, now = before['seconds'][phase], result['seconds'][phase]
+            changes.append('{} {:.2f}x'.format(phase, now / then if then else 0))
+        print "{:>7}: {}".format(result['size'], '  '.join(changes))
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="time humbug on made-up pages")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help="numbers of downloads to try (default: %(default)s)")
+    parser.add_argument('--per-item', type=int, default=4,
+                        help="downloads per item (default: %(default)s)")
+    parser.add_argument('--parser', default='html5lib',
+                        help="HTML parser humbug should use (default: %(default)s)")
+    parser.add_argument('--compact', action='store_true',
+                        help="run humbug with --compact")
+    parser.add_argument('--stream', action='store_true',
+                        help="run humbug with --stream")
+    parser.add_argument('--repeat', type=int, default=1,
+                        help="run each size this many times and keep the best")
+    parser.add_argument('--plain-size', type=int, default=64*1024,
+                        help="largest plain (hashed) file to put in the annex")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', '-o',
+                        help="where to write the JSON results (default: "
+                        "benchmarks/results/bench-COMMIT.json)")
+    parser.add_argument('--keep', action='store_true',
+                        help="don't delete the generated pages and annexes")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help="compare two sets of results instead of running")
+    options = parser.parse_args(args)
+
+    if options.compare:
+        compare(*options.compare)
+        return
+
+    # display_actions wants to know if it should go ahead.
+    __builtin__.raw_input = lambda prompt='': 'y'
+
+    commit = git_describe()
+    results = []
+    for size in options.sizes:
+        result = benchmark(size, options)
+        report(result)
+        results.append(result)
+
+    output = options.output
+    if not output:
+        if not os.path.isdir(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        output = os.path.join(RESULTS_DIR, 'bench-{}.json'.format(commit or 'unknown'))
+    with open(output, 'w') as f:
+        json.dump({
+            'commit': commit,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'parser': options.parser,
+            'compact': options.compact,
+            'stream': options.stream,
+            'per_item': options.per_item,
+            'repeat': options.repeat,
+            'seed': options.seed,
+            'results': results,
+        }, f, indent=2, sort_keys=True)
+    print "Wrote", output
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+"""
+Compare ways of hashing a file: throughput, and how much memory the
+process ends up using.
+
+Each method runs in a fresh process, so that its peak RSS isn't
+muddled up with the others'. --threads hashes that many files at
+once, the way the downloads and unpacking do.
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from src import utils
+
+def old_md5(filename, blocksize):
+    """What md5_file used to do: a new string for every block."""
+    hash = hashlib.md5()
+    f = file(filename)
+    while True:
+        s = f.read(blocksize)
+        if s == '':
+            break
+        hash.update(s)
+    return hash.hexdigest()
+
+def readinto_md5(filename, blocksize):
+    return utils.md5_and_size(filename, blocksize, mmap_threshold=None)[0]
+
+def mmap_md5(filename, blocksize):
+    return utils.md5_and_size(filename, blocksize, mmap_threshold=0)[0]
+
+METHODS = {
+    'old': old_md5,
+    'readinto': readinto_md5,
+    'mmap': mmap_md5,
+}
+
+def peak_rss():
+    """Peak resident set size of this process, in bytes."""
+    # Linux reports kilobytes; OS X, bytes.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+def child(method, blocksize, filenames):
+    """Hash filenames at once, one thread each, and report how it went."""
+    before = peak_rss()
+    hash = METHODS[method]
+    digests = [None] * len(filenames)
+    def run(i):
+        digests[i] = hash(filenames[i], blocksize)
+    threads = [threading.Thread(target=run, args=(i,))
+               for i in range(len(filenames))]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.time() - start
+    json.dump({'seconds': seconds, 'peak_rss': peak_rss(),
+               'rss_before': before, 'digests': digests}, sys.stdout)
+
+def make_file(filename, size):
+    chunk = os.urandom(1024*1024)
+    with open(filename, 'wb') as f:
+        written = 0
+        while written < size:
+            f.write(chunk[:size - written])
+            written += len(chunk)
+
+def run(method, blocksize, filenames):
+    output = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), '--child', method,
+         '--block-size', str(blocksize)] + filenames)
+    return json.loads(output)
+
+def format_mb(bytes):
+    return '{:.1f} MB'.format(bytes / (1024.0*1024))
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="compare ways of hashing a file")
+    parser.add_argument('--size', type=int, default=256,
+                        help="size of the test file in MB (default: %(default)s)")
+    parser.add_argument('--threads', type=int, default=1,
+                        help="hash this many files at once (default: %(default)s)")
+    parser.add_argument('--block-size', type=int, action='append',
+                        help="block sizes to try (default: 50 MB, the old size, "
+                        "and utils.BLOCKSIZE)")
+    parser.add_argument('--methods', nargs='+', choices=sorted(METHODS),
+                        default=['old', 'readinto', 'mmap'])
+    parser.add_argument('--output', '-o', help="also write the results here, as JSON")
+    parser.add_argument('--child', choices=sorted(METHODS), help=argparse.SUPPRESS)
+    parser.add_argument('filenames', nargs='*', help=argparse.SUPPRESS)
+    options = parser.parse_args(args)
+
+    if options.child:
+        child(options.child, options.block_size[0], options.filenames)
+        return
+
+    block_sizes = options.block_size or [50*1024*1024, utils.BLOCKSIZE]
+    workdir = tempfile.mkdtemp(prefix='humbug-hash-')
+    try:
+        filenames = []
+        for i in range(options.threads):
+            filename = os.path.join(workdir, 'file{}'.format(i))
+            make_file(filename, options.size*1024*1024)
+            filenames.append(filename)
+
+        results = []
+        expected = None
+        for method in options.methods:
+            for blocksize in block_sizes:
+                # Read everything once first, so that every method
+                # gets the page cache in the same state.
+                run('readinto', utils.BLOCKSIZE, filenames)
+                result = run(method, blocksize, filenames)
+                if expected is None:
+                    expected = result['digests']
+                elif result['digests'] != expected:
+                    raise AssertionError("{} got the wrong md5".format(method))
+                throughput = options.size*1024*1024*options.threads / result['seconds']
+                print "{:<9} block {:>9}: {:>9}/s, peak RSS {:>9} (+{})".format(
+                    method, format_mb(blocksize), format_mb(throughput),
+                    format_mb(result['peak_rss']),
+                    format_mb(result['peak_rss'] - result['rss_before']))
+                results.append({'method': method, 'block_size': blocksize,
+                                'threads': options.threads,
+                                'bytes_per_second': throughput,
+                                'peak_rss': result['peak_rss'],
+                                'rss_before': result['rss_before']})
+        if options.output:
+            with open(options.output, 'w') as f:
+                json.dump({'size': options.size*1024*1024, 'results': results}, f,
+                          indent=2, sort_keys=True)
+    finally:
+        for filename in os.listdir(workdir):
+            os.unlink(os.path.join(workdir, filename))
+        os.rmdir(workdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+"""
+Made-up Humble Bundle pages and annexes, for benchmarking.
+
+The page uses the same markup as the real home.html, so it goes
+through exactly the same code. The annex is laid out from wherever
+humbug decided the downloads should go (see bench.py), with some
+files already in place, some renamed, some old versions, some plain
+files that have to be hashed, and some missing.
+"""
+
+import os
+import random
+import hashlib
+from xml.sax.saxutils import escape
+
+# Downloads we might offer for each platform: (button label, filename
+# pattern, extra class on the download div).
+PLATFORM_DOWNLOADS = {
+    'linux': [
+        ('.deb', '{slug}_{version}_i386.deb', ''),
+        ('x86_64.deb', '{slug}_{version}_amd64.deb', 'arc64'),
+        ('.rpm', '{slug}-{version}.i386.rpm', ''),
+        ('.tar.gz', '{slug}-linux-{version}.tar.gz', ''),
+        ('.sh', '{slug}-{version}.sh', ''),
+    ],
+    'windows': [
+        ('Download', '{slug}-setup-{version}.exe', ''),
+        ('.zip', '{slug}-windows-{version}.zip', ''),
+    ],
+    'mac': [
+        ('Download', '{slug}-{version}.dmg', ''),
+    ],
+    'audio': [
+        ('MP3', '{slug}-soundtrack-mp3.zip', ''),
+        ('FLAC', '{slug}-soundtrack-flac.zip', ''),
+    ],
+}
+
+BOOK_DOWNLOADS = [
+    ('PDF', '{slug}.pdf', ''),
+    ('ePub', '{slug}.epub', ''),
+    ('MOBI', '{slug}.mobi', ''),
+]
+
+MOVIE_DOWNLOADS = [
+    ('Download 720p', '{slug}_720p.zip', ''),
+    ('Download 1080p', '{slug}_1080p.zip', ''),
+]
+
+# Every download div gets put in one of these, like on the real page.
+DOWNLOAD_TYPES = ['windows', 'linux', 'mac', 'android', 'audio', 'ebook',
+                  'comedy']
+
+# What fraction of downloads are already in the annex, and how.
+LAYOUT = [
+    ('present', 0.6),
+    ('renamed', 0.1),
+    ('old', 0.1),
+    ('plain', 0.05),
+    ('missing', 0.15),
+]
+
+class Download(object):
+    def __init__(self, title, label, filename, old_filename, cls, size, md5):
+        self.title = title
+        self.label = label
+        self.filename = filename
+        # What an earlier version of this download would have been called.
+        self.old_filename = old_filename
+        self.cls = cls
+        self.size = size
+        self.md5 = md5
+
+    def html(self):
+        url = 'http://dl.hwcdn.net/{}?key=bench&ttl=1'.format(self.filename)
+        return ('<div class="download {cls}">'
+                '<span class="label">{label}</span>'
+                '<a data-web="{url}">{label}</a>'
+                '<a class="dlmd5" href="#{md5}">md5</a>'
+                '<a class="dldate" data-timestamp="1355458142"></a>'
+                '<span class="mbs">{size}</span>'
+                '</div>').format(cls=self.cls, label=escape(self.label),
+                                 url=escape(url), md5=self.md5,
+                                 size=format_size(self.size))
+
+def format_size(size):
+    """How the page writes sizes: '1.2 GB' and so on."""
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if size < 1024 or unit == 'GB':
+            return '{:.1f} {}'.format(size, unit)
+        size /= 1024.0
+
+def make_item(rng, n, downloads_per_item):
+    """Make up an item. Returns (title, subtitle, {type: [Download]})."""
+    title = 'Synthetic Title {}'.format(n)
+    slug = 'synthetic{}'.format(n)
+    version = '{}.{}.{}'.format(rng.randint(1, 9), rng.randint(0, 20),
+                                rng.randint(0, 99))
+    kind = rng.random()
+    if kind < 0.1:
+        title = 'Synthetic Book {}'.format(n)
+        offered = [('ebook', d) for d in BOOK_DOWNLOADS]
+    elif kind < 0.15:
+        title = 'Synthetic Movie {}'.format(n)
+        offered = [('comedy', d) for d in MOVIE_DOWNLOADS]
+    else:
+        offered = [(type, d) for type in ['linux', 'windows', 'mac', 'audio']
+                   for d in PLATFORM_DOWNLOADS[type]]
+    chosen = rng.sample(offered, min(downloads_per_item, len(offered)))
+
+    downloads = {}
+    for type, (label, pattern, cls) in chosen:
+        filename = pattern.format(slug=slug, version=version)
+        old_filename = pattern.format(slug=slug, version='0.0.1')
+        size = rng.randint(1024, 2*1024*1024*1024)
+        md5 = hashlib.md5('{}/{}'.format(title, filename)).hexdigest()
+        downloads.setdefault(type, []).append(
+            Download(title, label, filename, old_filename, cls, size, md5))
+    return title, 'Synthetic Developer {}'.format(n % 97), downloads
+
+def make_page(filename, num_downloads, downloads_per_item=4, seed=0):
+    """Write a home.html offering about num_downloads downloads.
+
+    Returns {md5: Download} for everything on the page."""
+    rng = random.Random(seed)
+    offered = {}
+    with open(filename, 'w') as f:
+        f.write('<html><head><title>Synthetic Humble Page</title></head><body>\n')
+        n = 0
+        while len(offered) < num_downloads:
+            title, subtitle, downloads = make_item(rng, n, downloads_per_item)
+            n += 1
+            f.write('<div class="row"><div class="title">{}</div>'
+                    '<div class="subtitle">{}</div>'.format(escape(title),
+                                                            escape(subtitle)))
+            for type in DOWNLOAD_TYPES:
+                f.write('<div class="downloads {}">'.format(type))
+                for dl in downloads.get(type, []):
+                    f.write(dl.html())
+                    offered[dl.md5] = dl
+                f.write('</div>')
+            f.write('</div>\n')
+        f.write('</body></html>\n')
+    return offered
+
+def annex_link(root, relative, md5, size):
+    """Put a (dangling) git-annex symlink at root/relative."""
+    ext = os.path.splitext(relative)[1]
+    key = 'MD5E-s{}--{}{}'.format(size, md5, ext)
+    target = '../' * relative.count('/') + \
+        '.git/annex/objects/Xx/Yy/{0}/{0}'.format(key)
+    os.symlink(target, os.path.join(root, relative))
+
+def pick_layout(rng):
+    r = rng.random()
+    for layout, fraction in LAYOUT:
+        if r < fraction:
+            return layout
+        r -= fraction
+    return 'missing'
+
+def make_annex(root, targets, offered, plain_size=64*1024, seed=0):
+    """Lay out an annex under root for the downloads in targets.
+
+    targets is [(target_dir, target_filename, md5)], relative to
+    root. Plain files are sparse, and no bigger than plain_size, so
+    that hashing them doesn't swamp everything else.
+
+    Returns {layout: count}."""
+    rng = random.Random(seed)
+    os.makedirs(os.path.join(root, '.git', 'annex'))
+    counts = {}
+    for target_dir, target_filename, md5 in targets:
+        layout = pick_layout(rng)
+        counts[layout] = counts.get(layout, 0) + 1
+        if layout == 'missing':
+            continue
+        dirname = os.path.join(root, target_dir)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        dl = offered[md5]
+        size = dl.size
+        base, ext = os.path.splitext(target_filename)
+        relative = os.path.join(target_dir, target_filename)
+        if layout == 'present':
+            annex_link(root, relative, md5, size)
+        elif layout == 'renamed':
+            relative = os.path.join(target_dir, base + '-renamed' + ext)
+            annex_link(root, relative, md5, size)
+        elif layout == 'old':
+            if dl.old_filename == dl.filename:
+                # No version number to go back from.
+                relative = os.path.join(target_dir, base + '-old' + ext)
+            else:
+                relative = os.path.join(target_dir, dl.old_filename)
+            annex_link(root, relative, hashlib.md5('old ' + md5).hexdigest(), size)
+        elif layout == 'plain':
+            relative = os.path.join(target_dir, base + '-copy' + ext)
+            with open(os.path.join(root, relative), 'wb') as f:
+                f.truncate(min(size, plain_size))
+    return counts
@@ -0,0 +1,276 @@
+"""
+Helpers for talking to git-annex.
+"""
+
+import os
+import re
+import json
+import subprocess
+from src import instrument
+
+class Coprocess(object):
+    """A long-lived process that answers each line of input with one
+    line of output.
+
+    Many git and git-annex commands take a --batch option, which lets
+    us avoid paying the process startup cost for every file."""
+
+    # How many requests to write before reading back the
+    # answers. Small enough that neither pipe can fill up and
+    # deadlock us.
+    CHUNKSIZE = 100
+
+    def __init__(self, args):
+        self.args = args
+        self.process = None
+        self.broken = False
+
+    def start(self):
+        if self.process or self.broken:
+            return
+        try:
+            self.process = subprocess.Popen(self.args, stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE)
+            instrument.started_process(self.args)
+        except OSError:
+            # Not installed?
+            self.broken = True
+
+    def query_many(self, lines):
+        """Send each of lines, returning the list of responses.
+
+        If the process dies (or couldn't be started), the answer to
+        the remaining lines is None."""
+        if not lines:
+            return []
+        self.start()
+        with instrument.command(self.args):
+            responses = []
+            for start in range(0, len(lines), self.CHUNKSIZE):
+                chunk = lines[start:start+self.CHUNKSIZE]
+                if self.broken:
+                    responses.extend([None] * len(chunk))
+                    continue
+                answered = []
+                try:
+                    for line in chunk:
+                        self.process.stdin.write(encode(line) + '\n')
+                    self.process.stdin.flush()
+                    for line in chunk:
+                        response = self.process.stdout.readline()
+                        if not response:
+                            raise IOError("{} exited".format(self.args))
+                        answered.append(response.rstrip('\n'))
+                except IOError:
+                    self.close()
+                    self.broken = True
+                responses.extend(answered)
+                responses.extend([None] * (len(chunk) - len(answered)))
+        return responses
+
+    def query(self, line):
+        return self.query_many([line])[0]
+
+    def close(self):
+        if not self.process:
+            return
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        self.process.wait()
+        self.process = None
+
+def encode(path):
+    if isinstance(path, unicode):
+        return path.encode('utf-8')
+    return path
+
+class AnnexKey(object):
+    """A git-annex key, like MD5E-s1234--0123456789abcdef0123456789abcdef.zip"""
+    KEY_RE = re.compile(r'^(?P<backend>[A-Z0-9]+)(?P<fields>(-[a-zA-Z]\d+)*)--(?P<name>.*)$')
+    MD5_RE = re.compile(r'^[0-9a-f]{32}$')
+
+    def __init__(self, key):
+        self.key = key
+        self.backend = None
+        self.size = None
+        self.md5 = None
+
+        match = self.KEY_RE.match(key)
+        if not match:
+            return
+        self.backend = match.group('backend')
+        for field in match.group('fields').split('-'):
+            if field.startswith('s'):
+                self.size = int(field[1:])
+
+        if self.backend in ('MD5', 'MD5E'):
+            md5 = match.group('name')[:32]
+            if self.MD5_RE.match(md5):
+                self.md5 = md5
+
+    def __str__(self):
+        return self.key
+
+class KeyLookup(object):
+    """Finds the annex keys of files, remembering the answers.
+
+    Symlinked files have their key in the link target, which we can
+    read directly. Anything else goes through a single "git annex
+    lookupkey --batch" process (the session's, if there is one)."""
+    def __init__(self, session=None):
+        # path -> AnnexKey, or None if it's not annexed
+        self.keys = {}
+        if session:
+            self.lookupkey = session.lookupkey
+        else:
+            self.lookupkey = Coprocess(['git', 'annex', 'lookupkey', '--batch'])
+
+    def prefetch(self, paths):
+        """Look up the keys for all of paths in one go."""
+        todo = []
+        for path in paths:
+            if path in self.keys:
+                continue
+            if os.path.islink(path):
+                target = os.readlink(path)
+                if '/annex/objects/' in target:
+                    self.keys[path] = AnnexKey(os.path.basename(target))
+                else:
+                    self.keys[path] = None
+                continue
+            if not os.path.isfile(path):
+                self.keys[path] = None
+                continue
+            # Perhaps an unlocked file.
+            todo.append(path)
+
+        responses = self.lookupkey.query_many(todo)
+        for path, response in zip(todo, responses):
+            self.keys[path] = AnnexKey(response) if response else None
+
+    def key(self, path):
+        if path not in self.keys:
+            self.prefetch([path])
+        return self.keys[path]
+
+    def md5(self, path):
+        """Return the md5 of path if its key carries one, otherwise None.
+
+        This works even if the file's content isn't present."""
+        key = self.key(path)
+        return key and key.md5
+
+    def close(self):
+        self.lookupkey.close()
+
+class AnnexSession(object):
+    """The git and git-annex processes for one run.
+
+    Adding and dropping go through "git annex add/drop --batch"
+    processes, and lookups through "git annex lookupkey --batch",
+    which are kept open instead of starting a new process for every
+    file. Moves and removals are done to the working tree straight
+    away, and the matching index changes are saved up and handed to
+    a single "git update-index --index-info" when we sync.
+
+    git-annex only stages what it's added when its batch ends, and
+    git update-index holds the index lock for as long as it runs, so
+    sync() closes the add and drop processes and applies the saved
+    index changes. Call it before committing. They start up again
+    when they're next needed. Paths are relative to the top of the
+    repository, which should be the current directory."""
+
+    # What git update-index --index-info takes to mean "remove this path".
+    REMOVE = ('0', '0' * 40)
+
+    def __init__(self):
+        self.add_process = Coprocess(['git', 'annex', 'add', '--json', '--batch'])
+        self.drop_process = Coprocess(['git', 'annex', 'drop', '--force', '--json', '--batch'])
+        self.lookupkey = Coprocess(['git', 'annex', 'lookupkey', '--batch'])
+        # path -> (mode, sha) for everything in the index, once we need it
+        self.index = None
+        # [(mode, sha, path)] not given to git yet
+        self.pending_index = []
+
+    def run_batch(self, coprocess, paths):
+        for path, response in zip(paths, coprocess.query_many(paths)):
+            if response is None:
+                raise subprocess.CalledProcessError(1, ' '.join(coprocess.args))
+            if not response:
+                # git-annex skipped it -- not there, or already added.
+                print "git-annex skipped {}".format(encode(path))
+                continue
+            if not json.loads(response).get('success'):
+                raise subprocess.CalledProcessError(
+                    1, '{} {}'.format(' '.join(coprocess.args), encode(path)))
+
+    def add(self, paths):
+        self.run_batch(self.add_process, paths)
+
+    def drop(self, paths):
+        self.run_batch(self.drop_process, paths)
+
+    def index_entry(self, path):
+        """(mode, sha) of path in the index, or None if it isn't there."""
+        if self.index is None:
+            self.index = {}
+            output = instrument.check_output(['git', 'ls-files', '--stage', '-z'])
+            for line in output.split('\0'):
+                if not line:
+                    continue
+                info, name = line.split('\t', 1)
+                mode, sha, stage = info.split()
+                self.index[name] = (mode, sha)
+        return self.index.get(os.path.normpath(encode(path)))
+
+    def move(self, old_path, new_path):
+        """Like git mv."""
+        entry = self.index_entry(old_path)
+        if entry is None:
+            # Let git tell us what's wrong.
+            instrument.check_call(['git', 'mv', old_path, new_path])
+            return
+        os.rename(old_path, new_path)
+        old_path = os.path.normpath(encode(old_path))
+        new_path = os.path.normpath(encode(new_path))
+        self.pending_index.append(self.REMOVE + (old_path,))
+        self.pending_index.append(entry + (new_path,))
+        del self.index[old_path]
+        self.index[new_path] = entry
+
+    def remove(self, path):
+        """Like git rm."""
+        entry = self.index_entry(path)
+        if entry is None:
+            instrument.check_call(['git', 'rm', path])
+            return
+        os.unlink(path)
+        path = os.path.normpath(encode(path))
+        self.pending_index.append(self.REMOVE + (path,))
+        del self.index[path]
+
+    def sync(self):
+        """Make sure everything we've done so far is in the index."""
+        self.add_process.close()
+        self.drop_process.close()
+        if not self.pending_index:
+            return
+        entries, self.pending_index = self.pending_index, []
+        args = ['git', 'update-index', '-z', '--index-info']
+        instrument.started_process(args)
+        with instrument.command(args):
+            process = subprocess.Popen(args, stdin=subprocess.PIPE)
+            process.communicate(''.join('{} {}\t{}\0'.format(mode, sha, path)
+                                        for mode, sha, path in entries))
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, ' '.join(args))
+
+    def close(self):
+        """Finish up, leaving the index matching what we've done, even
+        if we're stopping because something went wrong."""
+        try:
+            self.sync()
+        finally:
+            self.lookupkey.close()
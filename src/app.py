@@ -1,11 +1,29 @@
 import os.path
+import sys
+import pstats
+import cProfile
 import argparse
-import subprocess
+import threading
 from collections import OrderedDict
 from src import filematch
-from src.humble_page import HumblePage
-from src.config import ANNEX_LOCATION
-from src.handlers import GameHandler, MovieHandler, BookHandler, AlbumHandler
+from src import utils
+from src import instrument
+from src import unpack
+from src import content_index
+from src.annex import KeyLookup, AnnexSession
+from src.executor import DownloadExecutor
+from src.pipeline import Pipeline
+from src.download import DOWNLOADERS
+from src.transaction import Transaction, BatchedTransaction
+from src.humble_page import HumblePage, PageCache, PARSERS, compare_parsers, changed_items
+from src.humble_orders import OrderData, is_order_data
+from src.hashcache import HashCache
+from src.hashpool import HashPool
+from src.tree_index import TreeIndex
+from src.candidates import OrderedPool
+from src.config import ANNEX_LOCATION, HASH_CACHE_FILE, PARTIAL_DIR, PAGE_CACHE_DIR
+from src.config import GAMES_SUBDIR, BOOKS_SUBDIR, MOVIES_SUBDIR, ALBUMS_SUBDIR
+from src.handlers import HandlerTable
 from src.utils import md5_file
 
 class HumbugDownload(object):
@@ -29,21 +47,98 @@ class HumbugDownload(object):
         return self.target_dir == rhs.target_dir \
             and self.target_filename == rhs.target_filename
 
+    def __ne__(self, rhs):
+        return not self == rhs
+
+    def __hash__(self):
+        return hash((self.target_dir, self.target_filename))
 
     def name_nice(self):
         return "{} - {}".format(self.item.title.encode('utf-8'),
                                 unicode(self.dl).encode('utf-8'))
 
+class HumbugLocalCopy(HumbugDownload):
+    """A download we don't need to download, because the same file
+    is already somewhere else in the annex."""
+    def __init__(self, handler, item, dl, target_dir, target_filename, unpack,
+                 source):
+        super(HumbugLocalCopy, self).__init__(handler, item, dl, target_dir,
+                                              target_filename, unpack)
+        self.source = source
+
+    def __str__(self):
+        if self.source is None:
+            return super(HumbugLocalCopy, self).__str__()
+        return "Copy {} to {}/{}".format(self.source.encode('utf-8'),
+                                         self.target_dir.encode('utf-8'),
+                                         self.target_filename.encode('utf-8'))
+
 class Humbug(object):
     def __init__(self, args=None):
         parser = argparse.ArgumentParser(description="munge Humble Bundle page into a git annex")
         parser.add_argument('filename', type=str,
-                            help="a saved version of the home.html page")
+                            help="a saved version of the home.html page, or a .json "
+                            "file of order data from Humble Bundle's API")
+        parser.add_argument('--parser', choices=PARSERS, default='html5lib',
+                            help="HTML parser to read the page with (default: %(default)s)")
+        parser.add_argument('--compact', action='store_true',
+                            help="copy what we need out of the page and then throw the parse tree away")
+        parser.add_argument('--stream', action='store_true',
+                            help="read the page a row at a time (each with --parser), so memory "
+                            "use doesn't grow with the size of the page")
+        parser.add_argument('--no-page-cache', action='store_true',
+                            help="parse the page even if we've seen it before")
+        parser.add_argument('--clear-page-cache', action='store_true',
+                            help="forget all the pages we've seen before")
+        parser.add_argument('--check-parser', action='store_true',
+                            help="check that --parser reads the page the same way as html5lib, then exit")
+        parser.add_argument('--previous', metavar='FILENAME',
+                            help="an earlier home.html; only look at items that changed since then")
         parser.add_argument('--include',
                             help="only do actions matching INCLUDE")
         parser.add_argument('--exclude',
                             help="only do actions matching EXCLUDE")
+        parser.add_argument('--jobs', '-j', type=int, default=1,
+                            help="number of downloads to run at once")
+        parser.add_argument('--per-host', type=int,
+                            help="number of downloads to run at once from any one host")
+        parser.add_argument('--unpack-jobs', type=int, default=1, metavar='N',
+                            help="number of archives to unpack at once, while downloads carry on")
+        parser.add_argument('--pipeline-depth', type=int, default=2, metavar='N',
+                            help="let at most N finished files wait for each of the next "
+                            "steps (unpacking, adding to the annex) before pausing downloads")
+        parser.add_argument('--downloader', choices=sorted(DOWNLOADERS),
+                            default='builtin',
+                            help="how to download files (default: %(default)s)")
+        parser.add_argument('--commit-every', type=int, default=1, metavar='N',
+                            help="commit after every N actions (0 means once at the end)")
+        parser.add_argument('--no-hash-cache', action='store_true',
+                            help="don't use or update the cache of file md5s")
+        parser.add_argument('--hash-jobs', type=int, default=1, metavar='N',
+                            help="hash the files we need to check in N processes, up front")
+        parser.add_argument('--readers-per-device', type=int, default=1, metavar='N',
+                            help="with --hash-jobs, how many files to read at once from one disk")
+        parser.add_argument('--hash-block-size', type=int, metavar='BYTES',
+                            help="how much of a file to hash at a time (default: {})".format(
+                                utils.BLOCKSIZE))
+        parser.add_argument('--mmap-threshold', type=int, metavar='BYTES',
+                            help="hash files at least this big with mmap instead of reading them")
+        parser.add_argument('--no-local-copies', action='store_true',
+                            help="download files even if the annex already has them somewhere else")
+        parser.add_argument('--timings', action='store_true',
+                            help="say where the time went at the end of the run")
+        parser.add_argument('--timings-json', metavar='FILENAME',
+                            help="write the timings to FILENAME as JSON")
+        parser.add_argument('--profile', action='store_true',
+                            help="run under cProfile and show the most expensive functions "
+                            "(only sees this thread, not the downloads)")
         self.config = parser.parse_args(args)
+        if self.config.timings_json:
+            # We're about to chdir into the annex.
+            self.config.timings_json = os.path.abspath(self.config.timings_json)
+        # Several progress bars on one terminal are just noise.
+        self.downloader = DOWNLOADERS[self.config.downloader](
+            quiet=self.config.jobs > 1, staging_dir=PARTIAL_DIR)
         # List of local files we had in the relevant directories.
         self.encountered_files = {}
         # List of local files we had that were matched.
@@ -52,6 +147,32 @@ class Humbug(object):
         # List of files we don't have already.
         # dir -> [hdl]
         self.download_queue = OrderedDict()
+        # The git-annex processes we keep around for the whole run.
+        self.annex = AnnexSession()
+        # Keys of the files in the annex, which tell us their md5s
+        # without having to read them.
+        self.annex_keys = KeyLookup(self.annex)
+        # md5s of local files, maybe worked out ahead of time.
+        self.hash_pool = HashPool(self.config.hash_jobs,
+                                  self.config.readers_per_device)
+        # Where else in the annex we can get a download from.
+        self.content_index = None
+        if not self.config.no_local_copies:
+            # (Only near the items we look at, with --previous.)
+            self.content_index = content_index.ContentIndex(
+                self.annex_keys,
+                [GAMES_SUBDIR, BOOKS_SUBDIR, MOVIES_SUBDIR, ALBUMS_SUBDIR],
+                everywhere=not self.config.previous)
+        # filename -> GameHandler.get_version_number(filename)
+        self.version_numbers = {}
+        # target_dir -> versions.VersionIndex of the files there
+        self.version_indexes = {}
+        # Which handler deals with which items. Add rules to this to
+        # handle new kinds of item.
+        self.handlers = HandlerTable()
+        # target_dir -> Lock, held while unpacking into that directory
+        self.dir_locks = {}
+        self.dir_locks_lock = threading.Lock()
 
     def go(self):
         os.chdir(ANNEX_LOCATION)
@@ -62,25 +183,89 @@ class Humbug(object):
             print "This doesn't seem like a git annex."
             print "Couldn't find {} or {}.".format(git_dir, annex_dir)
             print "Please run from inside a git annex."
-        page = HumblePage(self.config)
-        print page.title
-        for item in page.iteritems():
-            if item.has_book and not item.has_game:
-                handler = BookHandler
-            elif item.title == 'Kooky' or item.title.startswith('Indie Game'):
-                handler = MovieHandler
-            elif item.is_comedy:
-                handler = MovieHandler
-            elif item.has_soundtrack and not item.has_game:
-                # FIXME: figure out how to break these into Artist/Album
-                continue
-                handler = AlbumHandler
-            else:
-                handler = GameHandler
 
-            handler(self, item).handle()
+        if not self.config.no_hash_cache:
+            utils.hash_cache = HashCache(HASH_CACHE_FILE)
+        if self.config.hash_block_size:
+            utils.BLOCKSIZE = self.config.hash_block_size
+        if self.config.mmap_threshold is not None:
+            utils.MMAP_THRESHOLD = self.config.mmap_threshold
+        profile = None
+        if self.config.profile:
+            profile = cProfile.Profile()
+            profile.enable()
+        try:
+            self.process_page()
+        finally:
+            if profile:
+                profile.disable()
+            self.annex.close()
+            if utils.hash_cache:
+                utils.hash_cache.save()
+            self.report_timings(profile)
+
+    # How many functions --profile shows.
+    PROFILE_LINES = 25
+
+    def report_timings(self, profile=None):
+        if self.config.timings or profile:
+            print
+            print "\n".join(instrument.stats.summary())
+
+        extra = {}
+        if profile:
+            stats = pstats.Stats(profile, stream=sys.stdout)
+            stats.sort_stats('cumulative')
+            print
+            stats.print_stats(self.PROFILE_LINES)
+            functions = sorted(stats.stats.iteritems(),
+                               key=lambda entry: -entry[1][3])
+            extra['profile'] = [
+                {'function': pstats.func_std_string(func), 'calls': nc,
+                 'seconds': tt, 'cumulative_seconds': ct}
+                for func, (cc, nc, tt, ct, callers) in functions[:self.PROFILE_LINES]]
+
+        if self.config.timings_json:
+            instrument.stats.save(self.config.timings_json, extra)
+
+    def process_page(self):
+        if self.config.check_parser:
+            problems = compare_parsers(self.config, self.config.parser)
+            for problem in problems:
+                print problem.encode('utf-8')
+            print "{} differences between {} and html5lib.".format(
+                len(problems), 'streaming ' + self.config.parser if self.config.stream else self.config.parser)
+            return
 
-        wont_do_queue, action_queue = self.resolve_missing()
+        # Everything we download goes somewhere in here, so list it
+        # all up front rather than once per download. (Unless we're
+        # only looking at what changed, which won't be much.)
+        with instrument.phase('scan'):
+            self.tree = TreeIndex([GAMES_SUBDIR, BOOKS_SUBDIR, MOVIES_SUBDIR,
+                                   ALBUMS_SUBDIR],
+                                  eager=not self.config.previous)
+        with instrument.phase('parse'):
+            page_cache = PageCache(PAGE_CACHE_DIR)
+            if self.config.clear_page_cache:
+                page_cache.clear()
+            if self.config.no_page_cache:
+                page_cache = None
+            page = self.read_page(self.config.filename, page_cache)
+            print page.title
+            items = page.iteritems()
+            if self.config.previous:
+                previous = self.read_page(self.config.previous, page_cache)
+                items = changed_items(items, previous.iteritems())
+                print "{} items changed since {}".format(len(items), self.config.previous)
+
+        with instrument.phase('classify'):
+            for item in items:
+                handler = self.handler_for(item)
+                if handler:
+                    handler(self, item).handle()
+
+        with instrument.phase('resolve_missing'):
+            wont_do_queue, action_queue = self.resolve_missing()
         action_queue = self.display_actions(wont_do_queue, action_queue)
 
         if action_queue == None:
@@ -91,8 +276,20 @@ class Humbug(object):
             print "Exiting: Nothing to do."
             return
 
-        self.perform_actions(action_queue)
+        with instrument.phase('perform'):
+            self.perform_actions(action_queue)
+
+
+    def read_page(self, filename, page_cache):
+        """A HumblePage, or OrderData if filename is JSON from the API."""
+        if is_order_data(filename):
+            # This is quick enough not to bother caching.
+            return OrderData(filename)
+        return HumblePage(self.config, cache=page_cache, filename=filename)
 
+    def handler_for(self, item):
+        """Which kind of HumbugHandler deals with item, or None to skip it."""
+        return self.handlers.handler_for(item)
 
     def resolve_missing(self):
         """See if the queued downloads correspond to extant files.
@@ -104,13 +301,29 @@ class Humbug(object):
         OldVersion."""
         # Remove all the found files from self.encountered_files
         for dir, files in self.found_files.iteritems():
-            for file in files:
-                self.encountered_files[dir].remove(file)
+            self.encountered_files[dir] = [file for file in self.encountered_files[dir]
+                                           if file not in files]
 
         action_queue = []
         # dir -> [actions]
         wont_do_queue = {}
 
+        # Any of the unmatched files might have to be compared to a
+        # download, so look up all their keys in one batch.
+        self.annex_keys.prefetch([os.path.join(dir, file)
+                                  for dir in self.download_queue
+                                  for file in self.encountered_files.get(dir, [])])
+
+        # Anything that will have to be hashed can be hashed all at
+        # once, in parallel.
+        if self.config.hash_jobs > 1:
+            candidates = []
+            for dir, hdl_list in self.download_queue.iteritems():
+                candidates.extend(hdl_list[0].handler.hash_candidates(
+                        hdl_list, self.encountered_files.get(dir, [])))
+            with instrument.phase('hash'):
+                self.hash_pool.hash_all(candidates)
+
         for dir in self.download_queue:
             hdl_list = self.download_queue[dir]
 
@@ -121,20 +334,26 @@ class Humbug(object):
             action_list = handler.resolve_missing(
                 hdl_list, unknown_files)
             this_dir_actions = []
+            unknown_pool = OrderedPool(unknown_files)
+            hdl_pool = OrderedPool(hdl_list)
             for action in action_list:
-                unknown_files.remove(action.local_filename)
-                hdl_list.remove(action.hdl)
+                unknown_pool.remove(action.local_filename)
+                hdl_pool.remove(action.hdl)
                 # execute action, unless it's an UnpackedFile, which
                 # is basically a found_file
                 if not isinstance(action, filematch.UnpackedFile):
                     this_dir_actions.append(action)
+            unknown_files[:] = unknown_pool.remaining()
+            hdl_list[:] = hdl_pool.remaining()
 
+            queued = set()
             for hdl in hdl_list:
                 # Sometimes we have two different items with the same
                 # download -- in particular, several games have
                 # Android items as well as cross-platform items (with
                 # Mac, Win, Linux downloads).
-                if hdl not in this_dir_actions:
+                if hdl not in queued:
+                    queued.add(hdl)
                     this_dir_actions.append(hdl)
 
             if any(isinstance(action, filematch.FileMatchProblem)
@@ -143,8 +362,32 @@ class Humbug(object):
             else:
                 action_queue.extend(this_dir_actions)
 
+        if self.content_index:
+            self.check_copy_sources(action_queue)
+
         return (wont_do_queue, action_queue)
 
+    def check_copy_sources(self, action_queue):
+        """Download anything we were going to copy from a file that an
+        OldVersion will get rid of.
+
+        OldVersion drops the old file's content with --force, which
+        would take the content of a copy of it along too."""
+        removed = set()
+        removed_md5s = set()
+        for action in action_queue:
+            if isinstance(action, filematch.OldVersion):
+                path = os.path.join(action.hdl.target_dir, action.local_filename)
+                removed.add(os.path.normpath(path))
+                removed_md5s.add(self.annex_keys.md5(path))
+
+        for action in action_queue:
+            hdl = action if isinstance(action, HumbugDownload) else action.hdl
+            if not isinstance(hdl, HumbugLocalCopy):
+                continue
+            if os.path.normpath(hdl.source) in removed or hdl.dl.md5 in removed_md5s:
+                hdl.source = None
+
 
     def display_actions(self, wont_do_queue, actions_queue):
         """
@@ -199,88 +442,174 @@ class Humbug(object):
         return actions_queue
 
     def perform_actions(self, action_queue):
-        action_methods = {
-            HumbugDownload: self.perform_download,
+        local_methods = {
             filematch.SameFile: self.perform_samefile,
+            }
+        download_methods = {
+            HumbugDownload: self.perform_download,
+            HumbugLocalCopy: self.perform_localcopy,
             filematch.OldVersion: self.perform_oldversion,
             }
 
-        for action in action_queue:
-            action_methods[type(action)](action)
-
-    def perform_download(self, hdl):
-        self._download(hdl)
-        subprocess.check_call(["git", "commit", hdl.target_dir, "-m",
-                               'Download {}'.format(hdl.name_nice())])
-
-    def _download(self, hdl):
+        if self.config.commit_every == 1:
+            self.transaction = Transaction(self.annex)
+        else:
+            self.transaction = BatchedTransaction(self.annex,
+                                                  self.config.commit_every)
+
+        try:
+            # Actions that don't need the network can happen right away.
+            downloads = []
+            for action in action_queue:
+                if type(action) in local_methods:
+                    local_methods[type(action)](action)
+                else:
+                    hdl = action if isinstance(action, HumbugDownload) else action.hdl
+                    downloads.append((action, hdl))
+
+            # Fetch and unpack in the background, each in their own
+            # threads, but only touch the repository from this thread,
+            # as each file comes out the other end.
+            depth = self.config.pipeline_depth
+            executor = DownloadExecutor(self._fetch, self.config.jobs,
+                                        self.config.per_host, backlog=depth)
+            pipeline = Pipeline([('unpack', self._unpack_stage,
+                                  self.config.unpack_jobs)], depth)
+            for action, annexable_files in pipeline.run(executor.run(downloads)):
+                download_methods[type(action)](action, annexable_files)
+
+            self.transaction.finish()
+        finally:
+            self.transaction.close()
+
+    def perform_download(self, hdl, annexable_files):
+        self.transaction.annex_add(hdl.target_dir, annexable_files)
+        self.transaction.commit(hdl.target_dir,
+                                'Download {}'.format(hdl.name_nice()))
+
+    def perform_localcopy(self, hdl, annexable_files):
+        if hdl.source is None:
+            # We had to download it after all.
+            return self.perform_download(hdl, annexable_files)
+        self.transaction.annex_add(hdl.target_dir, annexable_files)
+        self.transaction.commit(hdl.target_dir,
+                                'Copy {} from {}'.format(hdl.name_nice(),
+                                                         hdl.source.encode('utf-8')))
+
+    def _fetch(self, hdl):
+        """Download hdl into its target directory.
+
+        Returns the list of files that should be added to the annex,
+        unless there's unpacking still to do. This doesn't touch the
+        repository, so it's safe to run several of these at once."""
         print str(hdl)
         if not os.path.exists(hdl.target_dir):
-            os.makedirs(hdl.target_dir)
+            try:
+                os.makedirs(hdl.target_dir)
+            except OSError:
+                # Another download got there first.
+                if not os.path.isdir(hdl.target_dir):
+                    raise
 
         # Use hdl.dl.filename here, which is the filename before unpacking.
-        subprocess.check_call(["curl", hdl.dl.url, '-o', hdl.dl.filename],
-                              cwd=hdl.target_dir)
-        assert md5_file(os.path.join(hdl.target_dir, hdl.dl.filename)) == hdl.dl.md5
-
-        annexable_files = [hdl.dl.filename]
-        if hdl.unpack:
-            annexable_files = []
-            tmpfilename = subprocess.check_output(['mktemp', '/tmp/aunpack.XXXXXXXXXX'])
-            tmpfilename = tmpfilename.strip()
-            subprocess.check_call(['aunpack', hdl.dl.filename,
-                                   '--save-outdir={}'.format(tmpfilename)],
-                                  cwd=hdl.target_dir)
-            tmpdir = file(tmpfilename).read().strip()
-            os.unlink(tmpfilename)
-            # tmpdir == "" means everything was unpacked to the current directory
-            if tmpdir:
-                tmpdir = os.path.join(hdl.target_dir, tmpdir)
-                # Try to move stuff out of the directory
-                for filename in os.listdir(tmpdir):
-                    unpacked_file = os.path.join(tmpdir, filename)
-                    target_file = os.path.join(hdl.target_dir, filename)
-                    if not os.path.exists(target_file):
-                        os.rename(unpacked_file, target_file)
-                        annexable_files.append(target_file)
-                    elif md5_file(unpacked_file) == md5_file(target_file):
-                        os.unlink(unpacked_file)
-                    else:
-                        print "Couldn't figure out what to do with unpacked file {}".format(unpacked_file)
-
-                try:
-                    os.rmdir(tmpdir)
-                except OSError:
-                    # Guess it wasn't empty. Oh well!
-                    print "Not removing directory {}".format(tmpdir)
-
-            os.unlink(os.path.join(hdl.target_dir, hdl.dl.filename))
-
-        # Use target_filename here, which is the filename we wanted to
-        # get out of the unpacked version.
-        subprocess.check_call(['git', 'annex', 'add'] + annexable_files,
+        path = os.path.join(hdl.target_dir, hdl.dl.filename)
+        if isinstance(hdl, HumbugLocalCopy) and hdl.source:
+            hdl.source = self.content_index.current(hdl.source)
+            if not os.path.lexists(hdl.source):
+                # Something else we did got rid of it.
+                hdl.source = None
+        if isinstance(hdl, HumbugLocalCopy) and hdl.source:
+            content_index.copy(hdl.source, path)
+        else:
+            self.downloader.fetch(hdl.dl.url, path, hdl.dl.md5)
+        return [hdl.dl.filename]
+
+    def _unpack_stage(self, action, annexable_files):
+        hdl = action if isinstance(action, HumbugDownload) else action.hdl
+        if not hdl.unpack:
+            return annexable_files
+        # Don't let two unpacks into the same directory fight over
+        # the files they're moving around.
+        with self.dir_lock(hdl.target_dir):
+            return self._unpack(hdl)
+
+    def _unpack(self, hdl):
+        # Zips and tarballs we can do ourselves, without reading
+        # anything twice.
+        annexable_files = unpack.unpack(
+            os.path.join(hdl.target_dir, hdl.dl.filename), hdl.target_dir,
+            self._existing_md5)
+        if annexable_files is not None:
+            return annexable_files
+        return self._aunpack(hdl)
+
+    def _existing_md5(self, path):
+        # Reading an annex symlink doesn't need the coprocess, so
+        # it's safe from the download threads.
+        if os.path.islink(path):
+            md5 = self.annex_keys.md5(path)
+            if md5:
+                return md5
+        return md5_file(path)
+
+    def _aunpack(self, hdl):
+        annexable_files = []
+        tmpfilename = instrument.check_output(['mktemp', '/tmp/aunpack.XXXXXXXXXX'])
+        tmpfilename = tmpfilename.strip()
+        instrument.check_call(['aunpack', hdl.dl.filename,
+                               '--save-outdir={}'.format(tmpfilename)],
                               cwd=hdl.target_dir)
+        tmpdir = file(tmpfilename).read().strip()
+        os.unlink(tmpfilename)
+        # tmpdir == "" means everything was unpacked to the current directory
+        if tmpdir:
+            tmpdir = os.path.join(hdl.target_dir, tmpdir)
+            # Try to move stuff out of the directory
+            for filename in os.listdir(tmpdir):
+                unpacked_file = os.path.join(tmpdir, filename)
+                target_file = os.path.join(hdl.target_dir, filename)
+                if not os.path.exists(target_file):
+                    os.rename(unpacked_file, target_file)
+                    annexable_files.append(filename)
+                elif md5_file(unpacked_file) == md5_file(target_file):
+                    os.unlink(unpacked_file)
+                else:
+                    print "Couldn't figure out what to do with unpacked file {}".format(unpacked_file)
+
+            try:
+                os.rmdir(tmpdir)
+            except OSError:
+                # Guess it wasn't empty. Oh well!
+                print "Not removing directory {}".format(tmpdir)
+
+        os.unlink(os.path.join(hdl.target_dir, hdl.dl.filename))
+        return annexable_files
 
     def perform_samefile(self, samefile):
         hdl = samefile.hdl
-        subprocess.check_call(['git', 'mv', samefile.local_filename,
-                               hdl.target_filename],
-                              cwd=hdl.target_dir)
-
-        subprocess.check_call(['git', 'commit', hdl.target_dir, '-m',
-                               'Rename {} in accordance with HIB'.format(
-                    hdl.item.title)])
-
-    def perform_oldversion(self, oldversion):
+        self.transaction.move(hdl.target_dir, samefile.local_filename,
+                              hdl.target_filename)
+        if self.content_index:
+            self.content_index.moved(
+                os.path.join(hdl.target_dir, samefile.local_filename),
+                os.path.join(hdl.target_dir, hdl.target_filename))
+
+        self.transaction.commit(hdl.target_dir,
+                                'Rename {} in accordance with HIB'.format(
+                hdl.item.title.encode('utf-8')))
+
+    def perform_oldversion(self, oldversion, annexable_files):
         hdl = oldversion.hdl
-        self._download(hdl)
+        self.transaction.annex_add(hdl.target_dir, annexable_files)
 
-        subprocess.check_call(['git', 'annex', 'drop', '--force', oldversion.local_filename],
-                              cwd=hdl.target_dir)
-        subprocess.check_call(['git', 'rm', oldversion.local_filename],
-                              cwd=hdl.target_dir)
-        subprocess.check_call(['git', 'commit', hdl.target_dir, '-m',
-                               'Replace old version of {}'.format(hdl.name_nice())])
+        self.transaction.annex_drop(hdl.target_dir, oldversion.local_filename)
+        self.transaction.remove(hdl.target_dir, oldversion.local_filename)
+        self.transaction.commit(hdl.target_dir,
+                                'Replace old version of {}'.format(hdl.name_nice()))
+
+    def dir_lock(self, target_dir):
+        with self.dir_locks_lock:
+            return self.dir_locks.setdefault(target_dir, threading.Lock())
 
     def found_file(self, target_dir, target_file):
         self.found_files.setdefault(target_dir, set()).add(target_file)
@@ -292,15 +621,29 @@ class Humbug(object):
             target_filename = dl.filename
         full_path = os.path.join(target_dir, target_filename)
 
-        if os.path.exists(target_dir):
-            self.encountered_files[target_dir] = os.listdir(target_dir)
+        if target_dir not in self.encountered_files:
+            listing = self.tree.listdir(target_dir)
+            if listing is not None:
+                self.encountered_files[target_dir] = listing
 
         # Use lexists because this could be a symlink that wasn't
         # annex-get'd on this machine
-        if os.path.lexists(full_path):
+        if self.tree.lexists(full_path):
             #print "  Exists:", target_filename
             self.found_file(target_dir, target_filename)
         else:
             #print "  Get:", full_path, dl.type, dl.name, dl.md5, dl.modified
-            self.download_queue.setdefault(target_dir, []).append(
-                HumbugDownload(handler, item, dl, target_dir, target_filename, unpack))
+            # Files elsewhere in target_dir might be this one renamed,
+            # which resolve_missing will sort out, but if it's in
+            # some other directory we can copy it from there.
+            source = None
+            if self.content_index:
+                source = self.content_index.find(dl.md5, exclude_dir=target_dir,
+                                                 need_content=unpack)
+            if source:
+                hdl = HumbugLocalCopy(handler, item, dl, target_dir,
+                                      target_filename, unpack, source)
+            else:
+                hdl = HumbugDownload(handler, item, dl, target_dir,
+                                     target_filename, unpack)
+            self.download_queue.setdefault(target_dir, []).append(hdl)
@@ -0,0 +1,64 @@
+"""
+Bookkeeping for matching downloads against local files, so that big
+directories don't make resolving quadratic.
+"""
+
+from collections import deque
+
+class OrderedPool(object):
+    """A list that elements can be taken out of cheaply.
+
+    remove() takes out the first remaining element equal to its
+    argument, like list.remove(), and first() is the remaining element
+    that came earliest. Elements have to be hashable."""
+    def __init__(self, elements):
+        self.elements = list(elements)
+        self.alive = [True] * len(self.elements)
+        self.count = len(self.elements)
+        self.head = 0
+        # element -> positions it's at, in order
+        self.positions = {}
+        for position, element in enumerate(self.elements):
+            self.positions.setdefault(element, deque()).append(position)
+        # filter name -> [positions of matching elements, index of the
+        # first one that might still be alive]
+        self.filters = {}
+
+    def __len__(self):
+        return self.count
+
+    def first(self):
+        while self.head < len(self.elements) and not self.alive[self.head]:
+            self.head += 1
+        if self.head < len(self.elements):
+            return self.elements[self.head]
+
+    def first_matching(self, name, predicate):
+        """Return the first remaining element for which predicate is true.
+
+        predicate is only evaluated once per element for each name,
+        so the same name should always go with the same predicate."""
+        if name not in self.filters:
+            self.filters[name] = [[position for position, element
+                                   in enumerate(self.elements)
+                                   if self.alive[position] and predicate(element)],
+                                  0]
+        matches = self.filters[name]
+        positions = matches[0]
+        while matches[1] < len(positions) and not self.alive[positions[matches[1]]]:
+            matches[1] += 1
+        if matches[1] < len(positions):
+            return self.elements[positions[matches[1]]]
+
+    def remove(self, element):
+        positions = self.positions.get(element)
+        while positions and not self.alive[positions[0]]:
+            positions.popleft()
+        if not positions:
+            raise ValueError, "{!r} not in pool".format(element)
+        self.alive[positions.popleft()] = False
+        self.count -= 1
+
+    def remaining(self):
+        return [element for element, alive in zip(self.elements, self.alive)
+                if alive]
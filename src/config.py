@@ -11,6 +11,16 @@ GAMES_SUBDIR = 'Games/'
 MOVIES_SUBDIR = 'Videos/Movies/'
 ALBUMS_SUBDIR = 'Music/'
 
+# Where humbug keeps its own state, relative to the annex.
+HUMBUG_DIR = '.git/humbug/'
+# Cache of md5s of files in the annex. See hashcache.HashCache.
+HASH_CACHE_FILE = HUMBUG_DIR + 'md5cache.json'
+# Items extracted from pages we've already parsed. See
+# humble_page.PageCache.
+PAGE_CACHE_DIR = HUMBUG_DIR + 'pages/'
+# Downloads in progress, kept so that they can be resumed.
+PARTIAL_DIR = HUMBUG_DIR + 'partial/'
+
 # Games are stored in
 # {ANNEX_LOCATION}/{GAMES_SUBDIR}/{game.title}/{TYPE_SUBDIR}/{filename}
 # with TYPE_SUBDIR indicating the OS and architecture the file was
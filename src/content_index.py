@@ -0,0 +1,150 @@
+"""
+Finding files anywhere in the annex by their md5.
+"""
+
+import os
+import shutil
+from src import utils
+from src.tree_index import list_entries
+
+class ContentIndex(object):
+    """Maps md5s to the files in the annex that have that content.
+
+    The same file is often offered by several items (Android and
+    cross-platform versions of a game, a soundtrack that's also sold
+    as an album, a game that comes back in a later bundle), so before
+    downloading something we can see if we've already got it.
+
+    The annex is walked a piece at a time, as lookups need it: first
+    the item directory (like Games/Foo) the download is going to, then
+    the other item directories under roots, then everything else
+    (apart from .git). A lookup stops walking once it finds something.
+    If everywhere is false, lookups only walk the item directory
+    they're for, so a run that only looks at a few items doesn't list
+    the whole annex; files in directories already walked still count.
+
+    Annexed files' md5s come from their keys. Other files are only
+    included if the hash cache already knows their md5: hashing the
+    whole annex would cost more than it saves."""
+    def __init__(self, annex_keys, roots, everywhere=True):
+        self.annex_keys = annex_keys
+        self.roots = [os.path.normpath(root) for root in roots]
+        self.everywhere = everywhere
+        # md5 -> [paths], for the parts we've walked so far
+        self.paths = {}
+        # Item directories we've walked, and '' once everything else has been
+        self.walked = set()
+        # old path -> new path, for files we've renamed since
+        self.renamed = {}
+
+    def area(self, path):
+        """The item directory path is in: the first directory below
+        one of the roots. None if it's not under any root."""
+        path = os.path.normpath(path)
+        for root in self.roots:
+            if path.startswith(root + os.sep):
+                return os.path.join(root, path[len(root) + 1:].split(os.sep)[0])
+        return None
+
+    def areas(self, near):
+        """Item directories and then '', in the order to walk them."""
+        if near is not None:
+            yield near
+        if not self.everywhere:
+            return
+        for root in self.roots:
+            root = unicode(root)
+            try:
+                entries = list_entries(root)
+            except OSError:
+                continue
+            for name, is_dir in entries:
+                if is_dir:
+                    yield os.path.join(root, name)
+        yield u''
+
+    def walk(self, area):
+        """Add the files in area to the index. Walking '' adds
+        everything that isn't in an item directory."""
+        self.walked.add(area)
+        files = []
+        todo = [unicode(area)]
+        while todo:
+            dir = todo.pop()
+            try:
+                entries = list_entries(dir or u'.')
+            except OSError:
+                continue
+            for name, is_dir in entries:
+                path = os.path.join(dir, name)
+                if not is_dir:
+                    files.append(path)
+                elif path != '.git' and (area or self.area(path) is None):
+                    todo.append(path)
+
+        self.annex_keys.prefetch(files)
+        for path in files:
+            md5 = self.annex_keys.md5(path)
+            if md5 is None and utils.hash_cache and not os.path.islink(path):
+                signature, md5 = utils.hash_cache.lookup(path)
+            if md5:
+                self.paths.setdefault(md5, []).append(path)
+
+    def find(self, md5, exclude_dir=None, need_content=False):
+        """Return the path of a file with this md5, or None.
+
+        Files in exclude_dir don't count (resolve_missing will see
+        those anyway). If need_content is true, the file has to be
+        present, not just a symlink to content that's somewhere else."""
+        near = None
+        if exclude_dir is not None:
+            exclude_dir = os.path.normpath(exclude_dir)
+            near = self.area(exclude_dir)
+        path = self.lookup(md5, exclude_dir, need_content)
+        if path:
+            return path
+        for area in self.areas(near):
+            if area in self.walked:
+                continue
+            self.walk(area)
+            path = self.lookup(md5, exclude_dir, need_content)
+            if path:
+                return path
+        return None
+
+    def lookup(self, md5, exclude_dir, need_content):
+        for path in self.paths.get(md5, []):
+            if os.path.dirname(path) == exclude_dir:
+                continue
+            if need_content and not os.path.exists(path):
+                continue
+            return path
+        return None
+
+    def moved(self, old_path, new_path):
+        """Note that a file was renamed after we found it."""
+        self.renamed[os.path.normpath(old_path)] = os.path.normpath(new_path)
+
+    def current(self, path):
+        """Where the file we found at path is now."""
+        path = os.path.normpath(path)
+        while path in self.renamed:
+            path = self.renamed[path]
+        return path
+
+def copy(source, target):
+    """Make target have the same content as source.
+
+    Annexed files are copied by pointing another symlink at the same
+    key, which doesn't need the content to be present. Anything else
+    is copied the hard way."""
+    if os.path.islink(source):
+        object_path = os.path.join(os.path.dirname(source), os.readlink(source))
+        os.symlink(os.path.relpath(object_path, os.path.dirname(target)), target)
+        return
+
+    shutil.copy2(source, target)
+    if utils.hash_cache:
+        signature, md5 = utils.hash_cache.lookup(source)
+        if md5:
+            utils.hash_cache.store(target, utils.hash_cache.signature(target), md5)
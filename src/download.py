@@ -0,0 +1,354 @@
+"""
+Fetching files from the Humble Bundle, checking their md5s on the way in.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import threading
+import subprocess
+import urllib2
+import urlparse
+from src import utils
+from src import instrument
+
+class DownloadError(Exception):
+    """The downloaded file wasn't what the Humble Bundle page promised."""
+    pass
+
+class RangeNotSupported(Exception):
+    """The server won't let us continue a partial download."""
+    pass
+
+class PartialTransfer(object):
+    """A download in progress, kept in a staging area so that an
+    interrupted run can pick up where it left off.
+
+    Next to the data we keep a journal recording what we're
+    downloading and how many bytes are known to be safely on disk.
+    Transfers are named after the md5 they should end up with, since
+    the URLs expire between runs."""
+
+    # Python can't save the state of an md5 object, so resuming
+    # rehashes the bytes we already have. That's still a lot cheaper
+    # than downloading them again.
+
+    def __init__(self, staging_dir, url, md5):
+        self.url = url
+        self.md5 = md5
+        self.data_path = os.path.join(staging_dir, md5 + '.part')
+        self.journal_path = os.path.join(staging_dir, md5 + '.journal')
+
+    def resume_offset(self):
+        """How many bytes we have from an earlier run."""
+        try:
+            with open(self.journal_path) as f:
+                journal = json.load(f)
+        except (IOError, ValueError):
+            return 0
+        if journal.get('md5') != self.md5 or not os.path.exists(self.data_path):
+            return 0
+        return min(journal['offset'], os.path.getsize(self.data_path))
+
+    def open(self, offset):
+        """Open the data file for appending after offset bytes.
+
+        Returns (file, md5 object primed with the first offset bytes)."""
+        hash = hashlib.md5()
+        if not offset:
+            return open(self.data_path, 'wb'), hash
+
+        f = open(self.data_path, 'r+b')
+        # Anything past the journalled offset might not have made it
+        # to disk intact.
+        f.truncate(offset)
+        start = time.time()
+        remaining = offset
+        while remaining:
+            chunk = f.read(min(remaining, Downloader.CHUNKSIZE))
+            if not chunk:
+                break
+            hash.update(chunk)
+            remaining -= len(chunk)
+        instrument.add_work('hash', offset - remaining, time.time() - start)
+        f.seek(offset)
+        return f, hash
+
+    def checkpoint(self, f, offset):
+        f.flush()
+        os.fsync(f.fileno())
+        tmpfilename = self.journal_path + '.tmp'
+        with open(tmpfilename, 'w') as journal:
+            json.dump({'md5': self.md5,
+                       'url': urlparse.urlparse(self.url).path,
+                       'offset': offset}, journal)
+        os.rename(tmpfilename, self.journal_path)
+
+    def finish(self, path):
+        """Move the completed download to path."""
+        shutil.move(self.data_path, path)
+        self.remove_journal()
+
+    def discard(self):
+        if os.path.exists(self.data_path):
+            os.unlink(self.data_path)
+        self.remove_journal()
+
+    def remove_journal(self):
+        if os.path.exists(self.journal_path):
+            os.unlink(self.journal_path)
+
+class Downloader(object):
+    """Writes a URL to disk, hashing the bytes as they arrive so that
+    we never have to read the file back to verify it.
+
+    Downloads are assembled in staging_dir (next to the target if
+    that's None) and can be resumed if a run is interrupted."""
+
+    CHUNKSIZE = 1024*1024
+    # How often to note our progress in the journal.
+    CHECKPOINT_INTERVAL = 64*1024*1024
+    # Seconds between calls to progress().
+    PROGRESS_INTERVAL = 1.0
+
+    def __init__(self, quiet=False, staging_dir=None):
+        self.quiet = quiet
+        self.staging_dir = staging_dir
+        # Two items can offer the same file, so don't let two
+        # downloads of the same md5 share a partial file at once.
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+
+    def open(self, url, offset=0):
+        """Return (stream, number of bytes expected or None).
+
+        The stream should start at byte offset of the file, or raise
+        RangeNotSupported if it can't. It has read(), close() (which
+        should raise if the transfer failed) and abort()."""
+        raise NotImplementedError, 'please override me'
+
+    def progress(self, url, done, total, rate, finished=False):
+        """Called every so often as url downloads, with how many bytes
+        of the file we have, how many it has (None if we don't know)
+        and how many bytes a second are arriving. Called once more
+        with finished=True when it stops."""
+        pass
+
+    def lock(self, md5):
+        with self.locks_lock:
+            return self.locks.setdefault(md5, threading.Lock())
+
+    def fetch(self, url, path, md5):
+        """Download url to path, checking that its md5 is md5.
+
+        On a mismatch, the partial download is thrown away and
+        DownloadError is raised. If the transfer is interrupted any
+        other way, it's kept so the next attempt can resume it."""
+        staging_dir = self.staging_dir or os.path.dirname(path)
+        if not os.path.exists(staging_dir):
+            try:
+                os.makedirs(staging_dir)
+            except OSError:
+                if not os.path.isdir(staging_dir):
+                    raise
+
+        with self.lock(md5):
+            partial = PartialTransfer(staging_dir, url, md5)
+            offset = partial.resume_offset()
+            f, hash = partial.open(offset)
+            if offset and hash.hexdigest() == md5:
+                # We got all of it last time, but didn't get to move
+                # it into place.
+                f.close()
+            else:
+                digest = self.download(f, hash, partial, offset, url, path)
+                if digest != md5:
+                    partial.discard()
+                    raise DownloadError("{}: md5 was {}, expected {}".format(
+                            url, digest, md5))
+            partial.finish(path)
+
+        # We know the md5 now, so nobody else needs to work it out.
+        if utils.hash_cache:
+            utils.hash_cache.store(path, utils.hash_cache.signature(path), md5)
+
+    def download(self, f, hash, partial, offset, url, path):
+        """Append the rest of url to f, returning the md5 of the whole file."""
+        try:
+            stream, length = self.open(url, offset)
+            if offset:
+                print "Resuming {} from byte {}".format(os.path.basename(path), offset)
+        except RangeNotSupported:
+            f.close()
+            offset = 0
+            f, hash = partial.open(offset)
+            stream, length = self.open(url)
+        except BaseException:
+            f.close()
+            raise
+
+        try:
+            return self.transfer(stream, f, hash, partial, offset, length, url)
+        except DownloadError:
+            stream.abort()
+            partial.discard()
+            raise
+        except BaseException:
+            stream.abort()
+            raise
+
+    def transfer(self, stream, f, hash, partial, offset, length, url):
+        """Copy stream to f, updating hash and the journal as we go."""
+        received = 0
+        last_checkpoint = offset
+        start = last_progress = time.time()
+        total = offset + length if length is not None else None
+        with f:
+            try:
+                while True:
+                    chunk = stream.read(self.CHUNKSIZE)
+                    if not chunk:
+                        break
+                    received += len(chunk)
+                    if length is not None and received > length:
+                        raise DownloadError("{}: got more than the {} bytes promised".format(
+                                url, length))
+                    hash.update(chunk)
+                    f.write(chunk)
+                    if offset + received - last_checkpoint >= self.CHECKPOINT_INTERVAL:
+                        last_checkpoint = offset + received
+                        partial.checkpoint(f, last_checkpoint)
+                    if time.time() - last_progress >= self.PROGRESS_INTERVAL:
+                        last_progress = time.time()
+                        self.progress(url, offset + received, total,
+                                      received / (last_progress - start))
+                stream.close()
+            finally:
+                # Whatever happened, remember how far we got.
+                partial.checkpoint(f, offset + received)
+                seconds = time.time() - start
+                instrument.add_work('download', received, seconds)
+                self.progress(url, offset + received, total,
+                              received / seconds if seconds else None,
+                              finished=True)
+
+        if length is not None and received < length:
+            # The connection dropped. What we have is fine, so keep
+            # it for next time.
+            raise IOError("{}: got {} bytes, expected {}".format(
+                    url, received, length))
+        return hash.hexdigest()
+
+class UrllibStream(object):
+    def __init__(self, response):
+        self.response = response
+        self.read = response.read
+
+    def close(self):
+        self.response.close()
+
+    abort = close
+
+class UrllibDownloader(Downloader):
+    """Download in-process, showing progress on stderr unless quiet
+    (like curl does)."""
+
+    HTTP_RANGE_NOT_SATISFIABLE = 416
+
+    def progress(self, url, done, total, rate, finished=False):
+        if self.quiet:
+            return
+        line = "  {}".format(instrument.format_bytes(done))
+        if total:
+            line += " of {} ({:.0f}%)".format(instrument.format_bytes(total),
+                                             100.0 * done / total)
+        if rate is not None:
+            line += ", {}/s".format(instrument.format_bytes(rate))
+        # Pad over whatever the last line left behind.
+        sys.stderr.write('\r{:<60}'.format(line))
+        if finished:
+            sys.stderr.write('\n')
+        sys.stderr.flush()
+
+    def open(self, url, offset=0):
+        request = urllib2.Request(url)
+        if offset:
+            request.add_header('Range', 'bytes={}-'.format(offset))
+        try:
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError, e:
+            if offset and e.code == self.HTTP_RANGE_NOT_SATISFIABLE:
+                raise RangeNotSupported(url)
+            raise
+        if offset and response.getcode() != 206:
+            response.close()
+            raise RangeNotSupported(url)
+        length = response.info().getheader('Content-Length')
+        return UrllibStream(response), int(length) if length else None
+
+class CurlStream(object):
+    def __init__(self, process):
+        self.process = process
+        self.read = process.stdout.read
+
+    def close(self):
+        self.process.stdout.close()
+        returncode = self.process.wait()
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, 'curl')
+
+    def abort(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+        self.process.stdout.close()
+        self.process.wait()
+
+class CurlDownloader(Downloader):
+    """Download using curl, reading its output through a pipe."""
+
+    # curl's exit codes when the server ignores or rejects our Range
+    # header. (22 is any HTTP error, which is what --fail turns a 416
+    # into; if it's something else, we'll hit it again when we start
+    # over.)
+    CURLE_HTTP_RETURNED_ERROR = 22
+    CURLE_RANGE_ERROR = 33
+
+    def open(self, url, offset=0):
+        args = ['curl', '--fail', '--location', url]
+        if offset:
+            args += ['--continue-at', str(offset)]
+        if self.quiet:
+            args += ['--silent', '--show-error']
+        instrument.started_process(args)
+        process = subprocess.Popen(args, stdout=subprocess.PIPE)
+        stream = CurlStream(process)
+        if offset:
+            # curl refuses to start if the server can't do ranges, so
+            # peek at the first chunk to find out.
+            first = process.stdout.read(1)
+            if not first:
+                if process.wait() in (self.CURLE_HTTP_RETURNED_ERROR,
+                                      self.CURLE_RANGE_ERROR):
+                    raise RangeNotSupported(url)
+            stream.read = PrependedRead(first, process.stdout.read)
+        return stream, None
+
+class PrependedRead(object):
+    """A read() function that returns some already-read bytes first."""
+    def __init__(self, head, read):
+        self.head = head
+        self.read = read
+
+    def __call__(self, size):
+        if self.head:
+            head, self.head = self.head, ''
+            return head + self.read(size - len(head))
+        return self.read(size)
+
+DOWNLOADERS = {
+    'builtin': UrllibDownloader,
+    'curl': CurlDownloader,
+}
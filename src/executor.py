@@ -0,0 +1,116 @@
+"""
+Running several downloads at once.
+"""
+
+import sys
+import threading
+import urlparse
+import Queue
+
+class DownloadExecutor(object):
+    """Runs a fetch function over a list of downloads on a pool of
+    worker threads.
+
+    At most `jobs` fetches run at once, and at most `per_host` of
+    those talk to the same host. Results are handed back to the
+    thread that called run(), so that whatever it does with them
+    (adding to the annex, committing) stays serialized.
+
+    If backlog is given, at most that many finished fetches wait to be
+    picked up; past that, the workers wait too, rather than
+    downloading more than whoever's reading the results can keep up
+    with."""
+
+    def __init__(self, fetch, jobs=1, per_host=None, backlog=None):
+        self.fetch = fetch
+        self.jobs = max(jobs, 1)
+        self.per_host = per_host
+        self.lock = threading.Condition()
+        # [(action, hdl)] that haven't been started yet
+        self.pending = []
+        # host -> number of fetches in progress
+        self.active = {}
+        self.results = Queue.Queue(backlog or 0)
+        self.cancelled = False
+
+    def host(self, hdl):
+        return urlparse.urlparse(hdl.dl.url).hostname
+
+    def next_job(self):
+        """Pick the first pending job whose host isn't saturated.
+
+        Waits until one is available. Returns None if there's nothing
+        left to do."""
+        with self.lock:
+            while True:
+                if self.cancelled or not self.pending:
+                    return None
+                for i, (action, hdl) in enumerate(self.pending):
+                    host = self.host(hdl)
+                    if self.per_host is None or \
+                            self.active.get(host, 0) < self.per_host:
+                        del self.pending[i]
+                        self.active[host] = self.active.get(host, 0) + 1
+                        return action, hdl, host
+                self.lock.wait()
+
+    def finish_job(self, host):
+        with self.lock:
+            self.active[host] -= 1
+            self.lock.notify_all()
+
+    def worker(self):
+        while True:
+            job = self.next_job()
+            if job is None:
+                return
+            action, hdl, host = job
+            try:
+                result = self.fetch(hdl)
+                self.put_result((action, result, None))
+            except BaseException:
+                self.put_result((action, None, sys.exc_info()))
+            finally:
+                self.finish_job(host)
+
+    def put_result(self, result):
+        # Nobody's going to read it if we've been cancelled.
+        while not self.cancelled:
+            try:
+                self.results.put(result, timeout=1)
+                return
+            except Queue.Full:
+                pass
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            self.lock.notify_all()
+
+    def run(self, downloads):
+        """Fetch each of downloads, a list of (action, hdl).
+
+        Yields (action, result) as each fetch finishes. If a fetch
+        raises, nothing new is started and the exception is re-raised
+        here."""
+        self.pending = list(downloads)
+        count = len(self.pending)
+        for i in range(min(self.jobs, count)):
+            thread = threading.Thread(target=self.worker)
+            thread.daemon = True
+            thread.start()
+
+        try:
+            for i in range(count):
+                # Use a timeout so that Ctrl-C still gets through.
+                while True:
+                    try:
+                        action, result, exc_info = self.results.get(timeout=1)
+                        break
+                    except Queue.Empty:
+                        pass
+                if exc_info:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                yield action, result
+        finally:
+            self.cancel()
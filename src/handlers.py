@@ -4,7 +4,9 @@ Handlers for different kind of items found in the Humble Bundle.
 
 import os.path
 from src.config import NAME_EXCEPTIONS, SOUNDTRACK_TYPES
-from src import utils
+from src import instrument
+from src.candidates import OrderedPool
+from src.humble_page import type_signature
 
 # BookHandler
 from src.config import BOOKS_SUBDIR
@@ -15,6 +17,7 @@ from distutils import version
 from src.config import GAMES_SUBDIR, GAME_TYPE_SUBDIR
 from src.filematch import SameFile, LinkMissing, OldVersion, UserInvestigate
 from src.versions import Timestamp, DateString, BackwardsDateString, DebianVersion
+from src.versions import VersionIndex
 
 # MovieHandler
 from src.config import MOVIES_SUBDIR, UNPACKED_NAMES, GAME_TYPE_SUBDIR
@@ -90,7 +93,7 @@ class HumbugHandler(object):
 
                 # At least mark the file as found if it does exist, so
                 # we don't confuse it with anything else.
-                if os.path.lexists(os.path.join(target_dir, filename)):
+                if self.application.tree.lexists(os.path.join(target_dir, filename)):
                     self.application.found_file(target_dir, filename)
                 continue
             versions[dl.md5] = True
@@ -112,6 +115,11 @@ class HumbugHandler(object):
         Returns a list of (FileMatch, hdl, filename)."""
         return []
 
+    def hash_candidates(self, hdl_list, file_list):
+        """The paths of any files in file_list that resolve_missing
+        might need the md5s of, so they can be hashed ahead of time."""
+        return []
+
     def filename_could_match(self, filename, filetype):
         # Don't match against any files. Force caller to fall back to
         # hoping there's only one file in the directory.
@@ -139,6 +147,25 @@ class HumbugHandler(object):
                 return filename
 
 
+    def size_could_match(self, hdl, local_path):
+        """Could local_path be hdl's download, going by its size?
+
+        The size comes from the annex key if there is one (so the
+        content doesn't have to be present), otherwise the file
+        itself. If we don't know either size, it could be."""
+        size_range = hdl.dl.size_range
+        if not size_range:
+            return True
+        key = self.application.annex_keys.key(local_path)
+        if key and key.size is not None:
+            size = key.size
+        elif os.path.exists(local_path):
+            size = os.path.getsize(local_path)
+        else:
+            return True
+        smallest, largest = size_range
+        return smallest <= size <= largest
+
     def resolve_missing_by_filetype(self, hdl_list, file_list):
         """A sample implementation of resolve_missing.
 
@@ -156,29 +183,33 @@ class HumbugHandler(object):
         # If the download doesn't have any filetype and there is only
         # one download and only one file, try to match those two.
         actions = []
-        file_list = file_list[:]
-        hdl_list = hdl_list[:]
+        files = OrderedPool(file_list)
+        hdls = OrderedPool(hdl_list)
 
-        while file_list and hdl_list:
+        while files and hdls:
             # Each time through the loop, we remove an element from
-            # hdl_list.  We may also remove an element from file_list
-            # if it seemed like the hdl matched it best.
-            hdl = hdl_list[0]
-            target_file = self.find_closest_file(hdl, file_list)
-            if not target_file and len(file_list) != 1:
+            # hdls.  We may also remove an element from files if it
+            # seemed like the hdl matched it best.
+            hdl = hdls.first()
+            filetype = hdl.dl.filetype
+            # Files are indexed by the filetypes they could match, so
+            # this doesn't scan every file for every download.
+            target_file = files.first_matching(
+                filetype, lambda filename: self.filename_could_match(filename, filetype))
+            if not target_file and len(files) != 1:
                 # Presumably a new flavor -- .rpm when previously it
                 # was just .deb or something.
                 # Download it as new.
-                hdl_list.pop(0)
+                hdls.remove(hdl)
                 continue
 
             if target_file:
                 # We're pretty sure this download corresponds to this file.
                 hdl_to_try = [hdl]
-            else:  # len(file_list) == 1
+            else:  # len(files) == 1
                 # Otherwise, we're gonna have to try all the downloads.
-                target_file = file_list[0]
-                hdl_to_try = hdl_list
+                target_file = files.first()
+                hdl_to_try = hdls.remaining()
 
             for hdl in hdl_to_try:
                 #print "Checking match:", hdl.target_filename, target_file
@@ -193,15 +224,15 @@ class HumbugHandler(object):
                 action = UserInvestigate
 
             #print action, hdl, target_file
-            file_list.remove(target_file)
-            hdl_list.remove(hdl)
+            files.remove(target_file)
+            hdls.remove(hdl)
             actions.append(action(hdl, target_file))
 
-        if file_list:
+        if files:
             # FIXME: this should be a warning. It might just be a
             # download that HIB doesn't offer any more, or it could be
             # a problem with humbug.
-            print "Leftover files:", file_list
+            print "Leftover files:", files.remaining()
 
         return actions
 
@@ -273,8 +304,14 @@ class GameHandler(HumbugHandler):
         """String munging function that gets to figure out if any part
         of this filename can be treated as a version number.
 
-        Returns a list of potential version numbers, sorted in order
-        of canonicality"""
+        Returns a tuple of potential version numbers, sorted in order
+        of canonicality. Each filename is only parsed once per run."""
+        numbers = self.application.version_numbers
+        if filename not in numbers:
+            numbers[filename] = tuple(self._parse_version_number(filename))
+        return numbers[filename]
+
+    def _parse_version_number(self, filename):
         parts = self.FILEPART_RE.split(filename)
         current_versions = []
         # Will be turned into a DebianVersion at the end
@@ -313,8 +350,35 @@ class GameHandler(HumbugHandler):
         current_versions.append(parts[0])
         return current_versions
 
-    def resolve_missing(self, *args, **kwargs):
-        return self.resolve_missing_by_filetype(*args, **kwargs)
+    def version_index(self, target_dir):
+        """The VersionIndex for the files in target_dir.
+
+        Shared by all the GameHandlers in this run."""
+        indexes = self.application.version_indexes
+        if target_dir not in indexes:
+            indexes[target_dir] = VersionIndex(self.get_version_number)
+        return indexes[target_dir]
+
+    def resolve_missing(self, hdl_list, file_list):
+        if hdl_list:
+            # Try the newest version of each file first, so that a
+            # download we already have is found rather than replacing
+            # an older copy of it.
+            index = self.version_index(hdl_list[0].target_dir)
+            file_list = index.newest_first(file_list)
+        return self.resolve_missing_by_filetype(hdl_list, file_list)
+
+    def hash_candidates(self, hdl_list, file_list):
+        keys = self.application.annex_keys
+        paths = []
+        for filename in file_list:
+            path = os.path.join(hdl_list[0].target_dir, filename)
+            # Same tests as does_match, before it hashes.
+            if keys.md5(path) is not None or not os.path.isfile(path):
+                continue
+            if any(self.size_could_match(hdl, path) for hdl in hdl_list):
+                paths.append(path)
+        return paths
 
     def does_match(self, hdl, filename):
         """Try to match two files up.
@@ -325,17 +389,94 @@ class GameHandler(HumbugHandler):
         caller knows something we don't."""
         hdl_version = self.get_version_number(hdl.target_filename)[0]
         # Try to find the same type of version number as in the remote version
-        for local_version in self.get_version_number(filename):
-            if type(hdl_version) == type(local_version) and \
-                    hdl_version > local_version:
-                return OldVersion
+        if self.version_index(hdl.target_dir).has_older(filename, hdl_version):
+            return OldVersion
 
-        # See if the MD5s are the same.
+        # See if the MD5s are the same. If the annex key has the md5
+        # in it, we don't even need the file to be present.
         local_path = os.path.join(hdl.target_dir, filename)
-        if not os.path.exists(local_path):
-            return LinkMissing
-
-        if hdl.dl.md5 == utils.md5_file(local_path):
+        local_md5 = self.application.annex_keys.md5(local_path)
+        if local_md5 is None:
+            # Before reading the whole thing, make sure it's about
+            # the right size.
+            if not self.size_could_match(hdl, local_path):
+                instrument.count('hashes skipped (wrong size)')
+                return False
+            if not os.path.exists(local_path):
+                return LinkMissing
+            local_md5 = self.application.hash_pool.md5(local_path)
+
+        if hdl.dl.md5 == local_md5:
             return SameFile
 
         return False
+
+# Which handler deals with an item, going by its type signature (see
+# humble_page.type_signature). The first rule wins whose kinds the
+# item has all of, and whose excluded kinds it has none of. If a rule
+# has titles, the item's title has to be one of them too ('Foo*'
+# matches anything starting with Foo). A handler of None means the
+# item is skipped. Items no rule wants go to DEFAULT_HANDLER.
+HANDLER_RULES = [
+    # (kinds, excluded kinds, titles, handler)
+    (['book'], ['game'], None, BookHandler),
+    ([], [], ['Kooky', 'Indie Game*'], MovieHandler),
+    (['comedy'], [], None, MovieHandler),
+    # FIXME: figure out how to break these into Artist/Album
+    (['soundtrack'], ['game'], None, None),
+]
+DEFAULT_HANDLER = GameHandler
+
+def title_matches(title, pattern):
+    if pattern.endswith('*'):
+        return title.startswith(pattern[:-1])
+    return title == pattern
+
+class HandlerTable(object):
+    """Chooses handlers for items by HANDLER_RULES, or rules like them.
+
+    Each combination of type signature and matching titles is only
+    looked up once; after that it's a dict lookup."""
+
+    def __init__(self, rules=HANDLER_RULES, default=DEFAULT_HANDLER):
+        self.rules = list(rules)
+        self.default = default
+        # Rules added with add() go in front of the ones we started with.
+        self.added = 0
+        self.chosen = {}
+
+    def add(self, handler, kinds=(), excluded=(), titles=None, index=None):
+        """Add a rule, before the one at index if given.
+
+        Otherwise it's checked after any other rules added this way,
+        but before the ones the table started with, so that it can
+        take over items they'd have handled (or skipped)."""
+        rule = (list(kinds), list(excluded), titles, handler)
+        if index is None:
+            index = self.added
+        if index <= self.added:
+            self.added += 1
+        self.rules.insert(index, rule)
+        self.chosen.clear()
+
+    def matching_titles(self, title):
+        """Every title in any rule that title matches."""
+        return frozenset(pattern
+                         for kinds, excluded, titles, handler in self.rules
+                         for pattern in titles or []
+                         if title_matches(title, pattern))
+
+    def handler_for(self, item):
+        key = (type_signature(item), self.matching_titles(item.title))
+        if key not in self.chosen:
+            self.chosen[key] = self.choose(*key)
+        return self.chosen[key]
+
+    def choose(self, signature, matching_titles):
+        for kinds, excluded, titles, handler in self.rules:
+            if not signature.issuperset(kinds) or not signature.isdisjoint(excluded):
+                continue
+            if titles is not None and matching_titles.isdisjoint(titles):
+                continue
+            return handler
+        return self.default
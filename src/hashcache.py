@@ -0,0 +1,99 @@
+"""
+Persistent cache of file MD5s, so that we don't have to reread
+multi-gigabyte files that haven't changed since the last run.
+"""
+
+import os
+import json
+
+class HashCache(object):
+    """An on-disk cache of md5s, keyed by path.
+
+    Each entry remembers the inode, size and mtime of the file when it
+    was hashed (following annex symlinks to their content). If any of
+    those have changed, the entry is ignored and the file gets
+    rehashed."""
+
+    # Bump this if the format of the cache file changes; old caches
+    # are then silently discarded.
+    VERSION = 1
+
+    def __init__(self, filename):
+        self.filename = filename
+        # path -> [inode, size, mtime, md5]
+        self.entries = {}
+        # Paths whose entries we've confirmed or written this run.
+        self.fresh = set()
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            # No cache yet, or it's corrupt. Start afresh.
+            return
+
+        if data.get('version') != self.VERSION:
+            self.dirty = True
+            return
+        self.entries = data['entries']
+
+    def save(self):
+        """Write the cache back to disk, evicting stale entries."""
+        for path in self.entries.keys():
+            if path in self.fresh:
+                continue
+            entry = self.entries[path]
+            if self.signature(path) != entry[:3]:
+                # The file was changed or removed since we hashed it.
+                del self.entries[path]
+                self.dirty = True
+
+        if not self.dirty:
+            return
+
+        cache_dir = os.path.dirname(self.filename)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        # Write to a temporary file and rename so that an interrupted
+        # run doesn't leave a truncated cache behind.
+        tmpfilename = self.filename + '.tmp'
+        with open(tmpfilename, 'w') as f:
+            json.dump({'version': self.VERSION, 'entries': self.entries}, f)
+        os.rename(tmpfilename, self.filename)
+        self.dirty = False
+
+    def key(self, path):
+        return os.path.normpath(path)
+
+    def signature(self, path):
+        """Return [inode, size, mtime] for path, or None if it's missing."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return [st.st_ino, st.st_size, st.st_mtime]
+
+    def lookup(self, path):
+        """Return (signature, md5) for path.
+
+        md5 is None if we don't have a valid cached hash. The
+        signature should be passed back to store() once the file is
+        hashed, so that changes made while hashing are noticed."""
+        key = self.key(path)
+        signature = self.signature(path)
+        entry = self.entries.get(key)
+        if entry and signature and entry[:3] == signature:
+            self.fresh.add(key)
+            return signature, entry[3]
+        return signature, None
+
+    def store(self, path, signature, md5):
+        if signature is None:
+            return
+        key = self.key(path)
+        self.entries[key] = signature + [md5]
+        self.fresh.add(key)
+        self.dirty = True
@@ -0,0 +1,115 @@
+"""
+Hashing lots of files at once, on several cores.
+"""
+
+import os
+import time
+import Queue
+import multiprocessing
+from collections import OrderedDict
+from src import utils
+from src import instrument
+
+def signature(path):
+    """[inode, size, mtime] for path, like hashcache.HashCache.signature."""
+    st = os.stat(path)
+    return [st.st_ino, st.st_size, st.st_mtime]
+
+def hash_file(path):
+    """Runs in a worker process.
+
+    Returns (path, signature before hashing, md5, bytes, seconds), or
+    (path, None, error message, 0, 0) if we couldn't read it.
+
+    Anything that goes wrong has to come back this way: if the task
+    raised, hash_all would never hear about it and wait forever."""
+    start = time.time()
+    try:
+        sig = signature(path)
+        md5, size = utils.md5_and_size(path)
+    except Exception, e:
+        return path, None, str(e), 0, 0
+    return path, sig, md5, size, time.time() - start
+
+class HashPool(object):
+    """Hashes files in worker processes ahead of time, so that
+    resolve_missing finds the answers waiting for it.
+
+    Files are grouped by the device they're on, and at most
+    per_device of them are read from any one device at once, so that
+    a disk isn't made to seek between several files while another
+    one sits idle."""
+
+    def __init__(self, jobs=1, per_device=1):
+        self.jobs = max(jobs, 1)
+        self.per_device = max(per_device, 1)
+        # path -> (signature, md5)
+        self.results = {}
+
+    def hash_all(self, paths):
+        """Hash each of paths that we don't already know the md5 of."""
+        # device -> [paths], in the order they were given
+        by_device = OrderedDict()
+        for path in paths:
+            if path in self.results:
+                continue
+            if utils.hash_cache and utils.hash_cache.lookup(path)[1]:
+                continue
+            try:
+                device = os.stat(path).st_dev
+            except OSError:
+                continue
+            queue = by_device.setdefault(device, [])
+            if path not in queue:
+                queue.append(path)
+        if not by_device:
+            return
+
+        pool = multiprocessing.Pool(min(self.jobs, sum(map(len, by_device.values()))))
+        done = Queue.Queue()
+        # device -> files being read from it
+        active = dict((device, 0) for device in by_device)
+        # path -> device, for files being hashed
+        running = {}
+        try:
+            while by_device or running:
+                for device, queue in by_device.items():
+                    while queue and active[device] < self.per_device:
+                        path = queue.pop(0)
+                        active[device] += 1
+                        running[path] = device
+                        pool.apply_async(hash_file, (path,), callback=done.put)
+                    if not queue:
+                        del by_device[device]
+
+                # Poll, so that Ctrl-C gets through.
+                while True:
+                    try:
+                        path, sig, md5, size, seconds = done.get(timeout=1)
+                        break
+                    except Queue.Empty:
+                        continue
+                active[running.pop(path)] -= 1
+                if sig is None:
+                    # Leave it for md5_file to complain about.
+                    continue
+                instrument.add_work('hash', size, seconds)
+                self.results[path] = (sig, md5)
+                if utils.hash_cache:
+                    utils.hash_cache.store(path, sig, md5)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def md5(self, path):
+        """The md5 of path, using what we worked out ahead of time if
+        the file hasn't changed since."""
+        if path in self.results:
+            sig, md5 = self.results[path]
+            try:
+                if signature(path) == sig:
+                    return md5
+            except OSError:
+                pass
+        return utils.md5_file(path)
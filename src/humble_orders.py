@@ -0,0 +1,114 @@
+"""
+Reading Humble Bundle's JSON order data, instead of scraping home.html.
+
+Save the response from https://www.humblebundle.com/api/v1/order/KEY
+for each of your orders. A file can hold one order, or a list of them.
+"""
+
+import json
+import urlparse
+from src.humble_page import ItemRecord, DownloadRecord, ITEM_FIELDS, DOWNLOAD_FIELDS
+from src.humble_page import GAME_TYPES
+
+# Platforms the JSON calls something else from the page.
+PLATFORM_TYPES = {
+    'video': 'comedy',
+}
+
+def is_order_data(filename):
+    return filename.lower().endswith('.json')
+
+def download_type(platform, name):
+    """Like HumbleDownload.type, which goes by the button text as
+    well as the platform."""
+    if name == 'Download Air':
+        return 'air'
+    if 'Flash' in name:
+        return 'flash'
+    if 'Mac OS 10.5' in name:
+        return 'mac10.5'
+    if 'Mac OS 10.6+' in name:
+        return 'mac10.6+'
+    return PLATFORM_TYPES.get(platform, platform)
+
+def download_arch(struct, name):
+    if str(struct.get('arch', '')) in ['64', '64-bit', 'x86_64', 'amd64']:
+        return '64-bit'
+    if '64-bit' in name or 'x86_64' in name:
+        return '64-bit'
+    return '32-bit'
+
+def download_record(platform, struct):
+    name = struct.get('name') or ''
+    url = (struct.get('url') or {}).get('web')
+    file_size = struct.get('file_size')
+    filesize = struct.get('human_size')
+    if not filesize and file_size is not None:
+        filesize = '{} bytes'.format(file_size)
+    timestamp = struct.get('timestamp')
+    fields = {
+        'name': name,
+        'md5': struct.get('md5'),
+        'modified': unicode(timestamp) if timestamp is not None else None,
+        'url': url,
+        'filesize': filesize,
+        'type': download_type(platform, name),
+        'arch': download_arch(struct, name),
+        'filename': urlparse.urlparse(url).path.strip('/') if url else None,
+        # Streams and the like link somewhere else instead.
+        'is_file': bool(url) and not struct.get('external_link'),
+        'file_size': file_size,
+    }
+    return DownloadRecord([fields[field] for field in DOWNLOAD_FIELDS])
+
+def subproduct_record(subproduct):
+    """An ItemRecord for one subproduct of an order."""
+    downloads = []
+    # Platforms with something to download.
+    platforms = set()
+    for download in subproduct.get('downloads') or []:
+        platform = download.get('platform')
+        structs = download.get('download_struct') or []
+        if structs:
+            platforms.add(platform)
+        for struct in structs:
+            record = download_record(platform, struct)
+            if record.is_file and not record.md5:
+                # Everything from checking a download to matching it
+                # with local files goes by its md5.
+                print u"Skipping '{}' for '{}': the order data has no md5 for it".format(
+                    record.name, subproduct.get('human_name')).encode('utf-8')
+                continue
+            downloads.append(record)
+
+    fields = {
+        'title': (subproduct.get('human_name') or '').strip(),
+        'subtitle': ((subproduct.get('payee') or {}).get('human_name') or '').strip(),
+        'has_book': 'ebook' in platforms,
+        'has_soundtrack': 'audio' in platforms,
+        'is_comedy': bool(platforms & set(['video', 'comedy'])),
+        'has_game': bool(platforms & set(GAME_TYPES)),
+    }
+    return ItemRecord([fields[field] for field in ITEM_FIELDS], downloads)
+
+class OrderData(object):
+    """The items in some saved orders, with the same interface as
+    humble_page.HumblePage."""
+
+    def __init__(self, filename):
+        with open(filename) as f:
+            data = json.load(f)
+        orders = data if isinstance(data, list) else [data]
+        if not all(isinstance(order, dict) and 'subproducts' in order
+                   for order in orders):
+            raise ValueError, "{} doesn't look like Humble Bundle order data".format(
+                filename)
+
+        names = [(order.get('product') or {}).get('human_name') for order in orders]
+        self.title = u', '.join(name for name in names if name) or u'Humble Bundle orders'
+        self.items = [subproduct_record(subproduct)
+                      for order in orders
+                      for subproduct in order['subproducts']]
+
+    def iteritems(self):
+        return self.items
@@ -1,7 +1,13 @@
 import os.path
+import re
+import json
+import codecs
+import HTMLParser
+import hashlib
 import urlparse
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from src import property_builder as P
+from src import utils
 from src.config import SOUNDTRACK_TYPES, VIDEO_TYPES
 
 class HumbleNode(object):
@@ -11,7 +17,108 @@ class HumbleNode(object):
     def __init__(self, node):
         self.node = node
 
-class HumbleDownload(HumbleNode):
+class DownloadDisplay(object):
+    """How to describe a download to the user.
+
+    Shared by HumbleDownload and DownloadRecord; only needs name,
+    type, filename, filesize and file_size."""
+    __slots__ = ()
+
+    @property
+    def filetype(self):
+        """The extension or other cue that someone will be able to use
+        to recognize the download in a local file.
+
+        None means you're on your own. Hopefully you've kept this file
+        by itself in a directory.."""
+        # Try the name
+        words = self.name.split()
+        if len(words) == 1:
+            # Maybe it's x86_64.deb
+            words = os.path.splitext(words[0])
+            if not words[-1]:
+                # it was just .zip or .sh or something
+                words = [words[0]]
+        if words[-1].startswith('.'):
+            return words[-1]
+        if words[-1] in SOUNDTRACK_TYPES:
+            return words[-1]
+        if words[-1] in VIDEO_TYPES:
+            return words[-1]
+
+        if self.name in ['Download', 'Download Mobile']:
+            return None
+        if self.name in ['Download Installer']:
+            return '.exe'
+        if self.type in ['air', 'flash']:
+            # Who knows what those files will look like
+            return None
+
+        print "This is weird. Can't figure out the filetype for", self.name, self.filename
+        return None
+
+    @property
+    def size_range(self):
+        """(smallest, largest) number of bytes the download could be,
+        going by the rounded size the page shows. None if we can't
+        tell."""
+        if self.file_size is not None:
+            # We were told exactly.
+            return self.file_size, self.file_size
+        return parse_filesize(self.filesize)
+
+    @property
+    def type_nice(self):
+        """User-friendlier version of type"""
+        return {'linux': "Linux",
+                'mac': "OSX",
+                'mac10.5': "OSX 10.5",
+                'mac10.6+': "OSX 10.6+",
+                'flash': "Flash",
+                'air': 'Adobe Air',
+                'windows': 'Windows',
+                'audio': 'Soundtrack',
+                }.get(self.type, self.type)
+
+    def __str__(self):
+        download_name = self.name
+        if 'Download' in download_name:
+            if self.filetype and not self.filetype == '.exe':
+                download_name = self.filetype
+            else:
+                download_name = self.type_nice
+        if download_name in SOUNDTRACK_TYPES:
+            download_name = "Soundtrack ({})".format(download_name)
+        if download_name in VIDEO_TYPES:
+            download_name = "{} format".format(download_name)
+        return download_name
+
+FILESIZE_RE = re.compile(r'^\s*(\d+(?:\.(\d+))?)\s*([a-zA-Z]*)\s*$')
+# Powers of 1000 or 1024 -- we don't know which the page means.
+FILESIZE_UNITS = {'': 0, 'b': 0, 'bytes': 0, 'k': 1, 'kb': 1, 'kib': 1,
+                  'm': 2, 'mb': 2, 'mib': 2, 'g': 3, 'gb': 3, 'gib': 3,
+                  't': 4, 'tb': 4, 'tib': 4}
+
+def parse_filesize(text):
+    """Turn something like '1.2 GB' into (smallest, largest) bytes.
+
+    The page rounds, and might mean either kind of gigabyte, so the
+    range covers being off by one in the last digit shown, in
+    either."""
+    match = FILESIZE_RE.match(text or '')
+    if not match:
+        return None
+    number, decimals, unit = match.groups()
+    power = FILESIZE_UNITS.get(unit.lower())
+    if power is None:
+        return None
+    number = float(number)
+    step = 10 ** -len(decimals or '')
+    smallest = max(number - step, 0) * 1000 ** power
+    largest = (number + step) * 1024 ** power
+    return int(smallest), int(largest) + 1
+
+class HumbleDownload(HumbleNode, DownloadDisplay):
     """A HumbleNode corresponding to a <div class="download">.
 
     This corresponds to a button on the Humble Bundle website, which
@@ -34,7 +141,11 @@ class HumbleDownload(HumbleNode):
     filesize = property(
         P.text(P.find('span', class_='mbs')))
 
+    # The page only has the rounded size.
+    file_size = None
+
     @property
+    @P.memoize
     def type(self):
         """Return the OS that the binary corresponds to.
 
@@ -69,52 +180,7 @@ class HumbleDownload(HumbleNode):
             return cls
 
     @property
-    def type_nice(self):
-        """User-friendlier version of type"""
-        return {'linux': "Linux",
-                'mac': "OSX",
-                'mac10.5': "OSX 10.5",
-                'mac10.6+': "OSX 10.6+",
-                'flash': "Flash",
-                'air': 'Adobe Air',
-                'windows': 'Windows',
-                'audio': 'Soundtrack',
-                }.get(self.type, self.type)
-
-    @property
-    def filetype(self):
-        """The extension or other cue that someone will be able to use
-        to recognize the download in a local file.
-
-        None means you're on your own. Hopefully you've kept this file
-        by itself in a directory.."""
-        # Try the name
-        words = self.name.split()
-        if len(words) == 1:
-            # Maybe it's x86_64.deb
-            words = os.path.splitext(words[0])
-            if not words[-1]:
-                # it was just .zip or .sh or something
-                words = [words[0]]
-        if words[-1].startswith('.'):
-            return words[-1]
-        if words[-1] in SOUNDTRACK_TYPES:
-            return words[-1]
-        if words[-1] in VIDEO_TYPES:
-            return words[-1]
-
-        if self.name in ['Download', 'Download Mobile']:
-            return None
-        if self.name in ['Download Installer']:
-            return '.exe'
-        if self.type in ['air', 'flash']:
-            # Who knows what those files will look like
-            return None
-
-        print "This is weird. Can't figure out the filetype for", self.name, self.filename
-        return None
-
-    @property
+    @P.memoize
     def arch(self):
         classes = self.node['class']
         if 'arc64' in classes:
@@ -129,6 +195,7 @@ class HumbleDownload(HumbleNode):
         return '32-bit'
 
     @property
+    @P.memoize
     def filename(self):
         a_node = self.node.find('a')
         href = a_node['data-web']
@@ -136,51 +203,432 @@ class HumbleDownload(HumbleNode):
         return parsed.path.strip('/')
 
     @property
+    @P.memoize
     def is_file(self):
         return '.hwcdn.net/' in self.node.find('a')['data-web']
 
-    def __str__(self):
-        download_name = self.name
-        if 'Download' in download_name:
-            if self.filetype and not self.filetype == '.exe':
-                download_name = self.filetype
-            else:
-                download_name = self.type_nice
-        if download_name in SOUNDTRACK_TYPES:
-            download_name = "Soundtrack ({})".format(download_name)
-        if download_name in VIDEO_TYPES:
-            download_name = "{} format".format(download_name)
-        return download_name
-
 class HumbleItem(HumbleNode):
     title = property(
         P.text(P.find('div', class_='title')))
     subtitle = property(
         P.text(P.find('div', class_='subtitle')))
-    has_book = property(
-        P.exists(P.text(P.find('div', class_='downloads ebook'))))
-    has_soundtrack = property(
-        P.exists(P.text(P.find('div', class_='downloads audio'))))
-    is_comedy = property(
-        P.exists(P.text(P.find('div', class_='downloads comedy'))))
+
+    @property
+    @P.memoize
+    def download_types(self):
+        """The types (ebook, audio, linux...) of the <div
+        class="downloads ...">s in this row that have anything in
+        them.
+
+        Worked out in one pass over the row, rather than a search
+        per type."""
+        types = set()
+        for node in self.node.find_all('div', class_='downloads'):
+            classes = [cls for cls in node['class'] if cls not in ['downloads', 'show']]
+            if classes and node.text.strip():
+                types.update(classes)
+        return frozenset(types)
+
+    @property
+    def has_book(self):
+        return 'ebook' in self.download_types
+
+    @property
+    def has_soundtrack(self):
+        return 'audio' in self.download_types
+
+    @property
+    def is_comedy(self):
+        return 'comedy' in self.download_types
 
     @property
     def has_game(self):
-        return any(self.node.select('div.downloads.'+type)[0].text.strip()
-                   for type in ['windows', 'android', 'linux', 'mac'])
+        return not self.download_types.isdisjoint(GAME_TYPES)
 
-    def downloads(self):
+    @P.memoize
+    def _downloads(self):
         return map(HumbleDownload,
                    self.node.find_all('div', class_='download'))
 
-class HumblePage(object):
-    def __init__(self, config):
-        self.tree = BeautifulSoup(file(config.filename).read().decode('utf-8'),
-                                  'html5lib')
+    def downloads(self):
+        return list(self._downloads())
+
+    def freeze(self):
+        """Copy everything the handlers need out of the tree."""
+        return ItemRecord.from_data(item_record(self))
+
+# Download types that make an item a game.
+GAME_TYPES = ['windows', 'android', 'linux', 'mac']
+
+def type_signature(item):
+    """The kinds of thing item offers, as a frozenset of 'book',
+    'game', 'soundtrack' and 'comedy'. This is all that's needed to
+    choose its handler (see handlers.HandlerTable).
+
+    item can be a HumbleItem or an ItemRecord."""
+    return frozenset(kind for kind, has in [('book', item.has_book),
+                                            ('game', item.has_game),
+                                            ('soundtrack', item.has_soundtrack),
+                                            ('comedy', item.is_comedy)]
+                     if has)
+
+# The fields that make up an item or a download, as far as the
+# handlers are concerned.
+ITEM_FIELDS = ['title', 'subtitle', 'has_book', 'has_soundtrack',
+               'is_comedy', 'has_game']
+# (filetype is worked out from name and type.)
+DOWNLOAD_FIELDS = ['name', 'md5', 'modified', 'url', 'filesize', 'type',
+                   'arch', 'filename', 'is_file', 'file_size']
+
+def get_field(node, field):
+    """Like getattr, but None if the page doesn't have it.
+
+    Links that aren't files have no md5, for instance."""
+    try:
+        return getattr(node, field)
+    except ValueError:
+        return None
 
-    @property
-    def title(self):
-        return self.tree.title.text
+class DownloadRecord(DownloadDisplay):
+    """A download extracted from the page, without the tree behind it."""
+    __slots__ = DOWNLOAD_FIELDS
+
+    def __init__(self, values):
+        for field, value in zip(DOWNLOAD_FIELDS, values):
+            setattr(self, field, value)
+
+class ItemRecord(object):
+    """An item extracted from the page, without the tree behind it."""
+    __slots__ = ITEM_FIELDS + ['_downloads']
+
+    def __init__(self, values, downloads):
+        for field, value in zip(ITEM_FIELDS, values):
+            setattr(self, field, value)
+        self._downloads = tuple(downloads)
+
+    @classmethod
+    def from_data(cls, data):
+        """Inverse of item_record."""
+        values, downloads = data
+        return cls(values, [DownloadRecord(dl_values) for dl_values in downloads])
+
+    def downloads(self):
+        return list(self._downloads)
+
+def item_record(item):
+    """Everything a handler could learn from item, as plain data.
+
+    item can be a HumbleItem or an ItemRecord."""
+    return (tuple(get_field(item, field) for field in ITEM_FIELDS),
+            [tuple(get_field(dl, field) for field in DOWNLOAD_FIELDS)
+             for dl in item.downloads()])
+
+# html5lib is the slowest, but the most forgiving. The others are
+# much faster, and can skip building the parts of the page we don't
+# look at.
+PARSERS = ['html5lib', 'lxml', 'html.parser']
+
+def is_title_or_row(name, attrs):
+    """SoupStrainer test for the only parts of the page we use."""
+    if name == 'title':
+        return True
+    if name != 'div':
+        return False
+    classes = attrs.get('class') or []
+    if isinstance(classes, basestring):
+        classes = classes.split()
+    return 'row' in classes
+
+# How much of the page to read at a time when streaming.
+STREAM_CHUNK = 64*1024
+
+class RowReader(HTMLParser.HTMLParser):
+    """Picks the title and the rows out of the page as it's fed,
+    holding on to nothing but the markup of the row it's in the
+    middle of.
+
+    (lxml's HTML push parser would be faster, but it buffers most of
+    the page before it says anything.)"""
+
+    def __init__(self):
+        HTMLParser.HTMLParser.__init__(self)
+        self.title = None
+        self.title_text = None
+        # Markup of the row we're in, and how many divs deep in it we are.
+        self.row = None
+        self.depth = 0
+        # ('title', text) or ('row', markup), since last emptied.
+        self.found = []
+
+    def handle_starttag(self, tag, attrs):
+        if self.row is not None:
+            self.row.append(self.get_starttag_text())
+            if tag == 'div':
+                self.depth += 1
+        elif tag == 'div' and 'row' in (dict(attrs).get('class') or '').split():
+            self.row = [self.get_starttag_text()]
+            self.depth = 1
+        elif tag == 'title' and self.title is None:
+            self.title_text = []
+
+    def handle_startendtag(self, tag, attrs):
+        if self.row is not None:
+            self.row.append(self.get_starttag_text())
+
+    def handle_endtag(self, tag):
+        if self.row is not None:
+            self.row.append(u'</{}>'.format(tag))
+            if tag == 'div':
+                self.depth -= 1
+                if self.depth == 0:
+                    self.found.append(('row', u''.join(self.row)))
+                    self.row = None
+        elif tag == 'title' and self.title_text is not None:
+            self.title = u''.join(self.title_text).strip()
+            self.title_text = None
+            self.found.append(('title', self.title))
+
+    def handle_data(self, data):
+        if self.row is not None:
+            self.row.append(data)
+        elif self.title_text is not None:
+            self.title_text.append(data)
+
+    def handle_entityref(self, name):
+        self.handle_reference(u'&{};'.format(name))
+
+    def handle_charref(self, name):
+        self.handle_reference(u'&#{};'.format(name))
+
+    def handle_reference(self, ref):
+        if self.row is not None:
+            self.row.append(ref)
+        elif self.title_text is not None:
+            self.title_text.append(self.unescape(ref))
+
+def stream_page(filename, parser='html5lib'):
+    """Read the page a piece at a time, rather than building a tree
+    of the whole thing.
+
+    Yields ('title', text) for the page title and ('item', ItemRecord)
+    for each row, as they come. Each row is parsed by itself (with
+    parser), copied
+    into a record and thrown away before it's yielded, so however long
+    the page is, only one row is in memory at a time."""
+    reader = RowReader()
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(STREAM_CHUNK)
+            reader.feed(decoder.decode(chunk, final=not chunk))
+            if not chunk:
+                reader.close()
+            for kind, value in reader.found:
+                if kind == 'row':
+                    # Give HumbleItem the BeautifulSoup it's used to,
+                    # but only of this row.
+                    soup = BeautifulSoup(value, parser)
+                    value = HumbleItem(soup.find('div', class_='row')).freeze()
+                    soup.decompose()
+                    kind = 'item'
+                yield kind, value
+            reader.found = []
+            if not chunk:
+                break
+
+class PageCache(object):
+    """The items extracted from pages we've read before.
+
+    Entries are keyed by the md5 of the page (and the parser used), so
+    rerunning against the same home.html doesn't have to parse it
+    again."""
+
+    # Bump this if the format of the entries changes.
+    VERSION = 2
+    # Number of pages to remember.
+    KEEP = 10
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def load(self, key):
+        """Return (title, [ItemRecord]) for key, or None."""
+        try:
+            with open(self.path(key)) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if data.get('version') != self.VERSION:
+            return None
+        # Note that this page was used, so it's kept longest.
+        os.utime(self.path(key), None)
+        return data['title'], [ItemRecord.from_data(item) for item in data['items']]
+
+    def save(self, key, title, items):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        tmpfilename = self.path(key) + '.tmp'
+        with open(tmpfilename, 'w') as f:
+            json.dump({'version': self.VERSION, 'title': title,
+                       'items': [item_record(item) for item in items]}, f)
+        os.rename(tmpfilename, self.path(key))
+        self.evict()
+
+    def entries(self):
+        if not os.path.isdir(self.cache_dir):
+            return []
+        return [os.path.join(self.cache_dir, filename)
+                for filename in os.listdir(self.cache_dir)
+                if filename.endswith('.json')]
+
+    def evict(self):
+        entries = sorted(self.entries(), key=os.path.getmtime, reverse=True)
+        for path in entries[self.KEEP:]:
+            os.unlink(path)
+
+    def clear(self):
+        for path in self.entries():
+            os.unlink(path)
+
+class HumblePage(object):
+    def __init__(self, config, parser=None, cache=None, filename=None, stream=None):
+        parser = parser or getattr(config, 'parser', 'html5lib')
+        if stream is None:
+            stream = getattr(config, 'stream', False)
+        self.compact = getattr(config, 'compact', False)
+        self.items = None
+        self.tree = None
+        self.events = None
+        filename = filename or config.filename
+        if stream:
+            # Don't read the whole page in just to hash it, either.
+            digest = utils.md5_and_size(filename)[0]
+        else:
+            raw = file(filename).read()
+            digest = hashlib.md5(raw).hexdigest()
+
+        self.cache = cache
+        self.cache_key = '{}-{}'.format(digest, parser)
+        if stream:
+            self.cache_key += '-stream'
+        cached = cache and cache.load(self.cache_key)
+        if cached:
+            self.title, self.items = cached
+            return
+        if stream:
+            self.start_stream(filename, parser)
+            return
+        if cache:
+            # We'll need records to put in the cache anyhow.
+            self.compact = True
+
+        markup = raw.decode('utf-8')
+        if parser == 'html5lib':
+            # html5lib doesn't support parse_only.
+            self.tree = BeautifulSoup(markup, parser)
+        else:
+            self.tree = BeautifulSoup(markup, parser,
+                                      parse_only=SoupStrainer(is_title_or_row))
+        self.title = self.tree.title.text
+
+    def start_stream(self, filename, parser):
+        # The title comes before the rows, but hang on to any rows
+        # that don't.
+        self.events = stream_page(filename, parser)
+        self.early = []
+        self.title = None
+        for kind, value in self.events:
+            if kind == 'title':
+                self.title = value
+                break
+            self.early.append(value)
+
+    def stream_items(self):
+        """Yield the rest of the items as they're read."""
+        records = [] if self.cache else None
+        for record in self.early:
+            if records is not None:
+                records.append(record)
+            yield record
+        self.early = []
+        for kind, value in self.events:
+            if kind != 'item':
+                continue
+            # The records are small; it's the trees that take room.
+            if records is not None:
+                records.append(value)
+            yield value
+        if records is not None:
+            self.cache.save(self.cache_key, self.title, records)
 
     def iteritems(self):
-        return map(HumbleItem, self.tree.find_all('div', class_='row'))
+        if self.items is not None:
+            return self.items
+        if self.events is not None:
+            # Only good for one pass, unlike the lists.
+            return self.stream_items()
+
+        self.items = map(HumbleItem, self.tree.find_all('div', class_='row'))
+        if self.compact:
+            self.items = [item.freeze() for item in self.items]
+            # Nothing refers to the tree any more, so let it go.
+            self.tree.decompose()
+            self.tree = None
+            if self.cache:
+                self.cache.save(self.cache_key, self.title, self.items)
+        return self.items
+
+def item_signature(item):
+    """What identifies item and the state of its downloads.
+
+    URLs are compared without their query strings, which change every
+    time the page is saved."""
+    return (item.title, item.subtitle,
+            frozenset((dl.md5, dl.filename, urlparse.urlsplit(dl.url or '')[:3])
+                      for dl in item.downloads()))
+
+def changed_items(items, previous_items):
+    """Return the items whose downloads aren't the same as in previous_items.
+
+    New items count as changed."""
+    previous = {}
+    for item in previous_items:
+        signature = item_signature(item)
+        previous[signature] = previous.get(signature, 0) + 1
+
+    changed = []
+    for item in items:
+        signature = item_signature(item)
+        if previous.get(signature):
+            previous[signature] -= 1
+        else:
+            changed.append(item)
+    return changed
+
+def compare_parsers(config, parser, reference='html5lib'):
+    """Check that parsing with parser finds the same items and
+    downloads as parsing with reference.
+
+    Returns a list of descriptions of the differences."""
+    def records(parser, stream=False):
+        page = HumblePage(config, parser, stream=stream)
+        return [page.title] + [item_record(item) for item in page.iteritems()]
+
+    expected = records(reference)
+    got = records(parser, getattr(config, 'stream', False))
+    problems = []
+    if expected[0] != got[0]:
+        problems.append(u"title: {!r} with {}, {!r} with {}".format(
+                expected[0], reference, got[0], parser))
+    if len(expected) != len(got):
+        problems.append(u"{} items with {}, {} with {}".format(
+                len(expected) - 1, reference, len(got) - 1, parser))
+    for expected_item, got_item in zip(expected[1:], got[1:]):
+        if expected_item != got_item:
+            problems.append(u"item {!r}: {!r} with {}, {!r} with {}".format(
+                    expected_item[0][0], expected_item, reference,
+                    got_item, parser))
+    return problems
@@ -0,0 +1,168 @@
+"""
+Keeping track of where the time goes.
+
+Phases of the run, external commands, hashing and downloading are
+all counted and timed as they happen. It's cheap enough to do all the
+time; --timings prints the results at the end.
+"""
+
+import os
+import json
+import time
+import threading
+import contextlib
+import subprocess
+from collections import OrderedDict
+
+class Stats(object):
+    """Counts and times for one run. Safe to update from several threads."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        # name -> [times run, seconds], in the order they first ran
+        self.phases = OrderedDict()
+        # name -> [processes started, calls, seconds]
+        self.commands = {}
+        # 'hash', 'download' or 'unpack' -> [files, bytes, seconds]
+        self.work = {}
+        # Anything else worth counting: name -> number
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                entry = self.phases.setdefault(name, [0, 0.0])
+                entry[0] += 1
+                entry[1] += time.time() - start
+
+    def started_process(self, args):
+        with self.lock:
+            self.commands.setdefault(command_name(args), [0, 0, 0.0])[0] += 1
+
+    @contextlib.contextmanager
+    def command(self, args):
+        """Time a call to the command args. It doesn't have to start
+        a new process, if it's talking to a coprocess."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                entry = self.commands.setdefault(command_name(args), [0, 0, 0.0])
+                entry[1] += 1
+                entry[2] += time.time() - start
+
+    def add_work(self, kind, bytes, seconds, files=1):
+        with self.lock:
+            entry = self.work.setdefault(kind, [0, 0, 0.0])
+            entry[0] += files
+            entry[1] += bytes
+            entry[2] += seconds
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def git_invocations(self):
+        return sum(processes for name, (processes, calls, seconds)
+                   in self.commands.iteritems() if name.startswith('git'))
+
+    def report(self):
+        """Everything we know, as plain data."""
+        work = {}
+        for kind, (files, bytes, seconds) in self.work.iteritems():
+            work[kind] = {'files': files, 'bytes': bytes, 'seconds': seconds,
+                          'bytes_per_second': bytes / seconds if seconds else None}
+        return {
+            'total_seconds': time.time() - self.started,
+            'phases': [{'name': name, 'count': count, 'seconds': seconds}
+                       for name, (count, seconds) in self.phases.iteritems()],
+            'commands': dict((name, {'processes': processes, 'calls': calls,
+                                     'seconds': seconds})
+                             for name, (processes, calls, seconds)
+                             in self.commands.iteritems()),
+            'git_invocations': self.git_invocations(),
+            'work': work,
+            'counters': dict(self.counters),
+        }
+
+    def summary(self):
+        """A human-readable report, as a list of lines."""
+        lines = ["Timings:"]
+        for name, (count, seconds) in self.phases.iteritems():
+            lines.append("  {:<20} {:8.3f}s".format(name, seconds))
+        lines.append("  {:<20} {:8.3f}s".format('total', time.time() - self.started))
+
+        if self.commands:
+            lines.append("Commands:")
+            for name, (processes, calls, seconds) in sorted(self.commands.iteritems()):
+                lines.append("  {:<30} {:5} processes {:6} calls {:8.3f}s".format(
+                        name, processes, calls, seconds))
+        lines.append("git invocations: {}".format(self.git_invocations()))
+
+        for kind, verb in [('hash', 'Hashed'), ('download', 'Downloaded'),
+                           ('unpack', 'Unpacked')]:
+            files, bytes, seconds = self.work.get(kind, [0, 0, 0.0])
+            line = "{} {} files, {} in {:.3f}s".format(
+                verb, files, format_bytes(bytes), seconds)
+            if seconds:
+                line += " ({}/s)".format(format_bytes(bytes / seconds))
+            lines.append(line)
+        for name, count in sorted(self.counters.iteritems()):
+            lines.append("{}: {}".format(name, count))
+        return lines
+
+    def save(self, filename, extra=None):
+        report = self.report()
+        report.update(extra or {})
+        with open(filename, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+def command_name(args):
+    """What to file a command under: the program, plus the subcommand for git."""
+    name = os.path.basename(args[0])
+    if name == 'git' and len(args) > 1:
+        name += ' ' + args[1]
+        if args[1] == 'annex' and len(args) > 2:
+            name += ' ' + args[2]
+    return name
+
+def format_bytes(bytes):
+    for unit in ['B', 'kB', 'MB', 'GB', 'TB']:
+        if bytes < 1024 or unit == 'TB':
+            return '{:.1f} {}'.format(bytes, unit)
+        bytes /= 1024.0
+
+# The stats for this run.
+stats = Stats()
+
+def phase(name):
+    return stats.phase(name)
+
+def command(args):
+    return stats.command(args)
+
+def started_process(args):
+    stats.started_process(args)
+
+def add_work(kind, bytes, seconds, files=1):
+    stats.add_work(kind, bytes, seconds, files)
+
+def count(name, amount=1):
+    stats.count(name, amount)
+
+def check_call(args, **kwargs):
+    """subprocess.check_call, but counted."""
+    started_process(args)
+    with command(args):
+        return subprocess.check_call(args, **kwargs)
+
+def check_output(args, **kwargs):
+    """subprocess.check_output, but counted."""
+    started_process(args)
+    with command(args):
+        return subprocess.check_output(args, **kwargs)
@@ -0,0 +1,130 @@
+"""
+Running actions through several stages at once.
+"""
+
+import sys
+import threading
+import Queue
+from src import instrument
+
+# Passed down the queues once there's nothing more coming.
+DONE = object()
+
+class Pipeline(object):
+    """Passes (action, value) pairs through a series of stages, each
+    with its own worker threads, so that different actions can be at
+    different stages at the same time: while one file is being
+    unpacked, the next can be downloading, and the one before can be
+    added to the annex by whoever's reading the results.
+
+    stages is a list of (name, func, workers). func(action, value)
+    returns the value to hand to the next stage. Each stage's queue
+    holds at most depth pairs; if a stage falls behind, the ones
+    before it wait rather than piling up work (and files) it hasn't
+    got to yet."""
+
+    def __init__(self, stages, depth=2):
+        self.stages = stages
+        self.depth = max(depth, 1)
+        self.cancelled = False
+        # The first exception any thread hit, as sys.exc_info().
+        self.exc_info = None
+        self.lock = threading.Lock()
+
+    def put(self, queue, item):
+        """queue.put, giving up if we're cancelled."""
+        while not self.cancelled:
+            try:
+                queue.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def get(self, queue):
+        """queue.get, returning DONE if we're cancelled."""
+        while not self.cancelled:
+            try:
+                return queue.get(timeout=1)
+            except Queue.Empty:
+                pass
+        return DONE
+
+    def fail(self):
+        with self.lock:
+            if self.exc_info is None:
+                self.exc_info = sys.exc_info()
+        self.cancelled = True
+
+    def feed(self, source, queue, consumers):
+        try:
+            for pair in source:
+                if not self.put(queue, pair):
+                    return
+        except BaseException:
+            self.fail()
+        finally:
+            # Let a generator clean up (DownloadExecutor.run cancels
+            # its downloads) now, rather than whenever it's collected.
+            if hasattr(source, 'close'):
+                source.close()
+        for i in range(consumers):
+            self.put(queue, DONE)
+
+    def work(self, name, func, inbox, outbox, remaining, consumers):
+        try:
+            while True:
+                pair = self.get(inbox)
+                if pair is DONE:
+                    break
+                action, value = pair
+                with instrument.phase('pipeline: ' + name):
+                    value = func(action, value)
+                if not self.put(outbox, (action, value)):
+                    break
+        except BaseException:
+            self.fail()
+        finally:
+            # The last worker out tells the next stage.
+            with self.lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                for i in range(consumers):
+                    self.put(outbox, DONE)
+
+    def start(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def run(self, source):
+        """Run each (action, value) from the iterable source through
+        the stages.
+
+        source is read from a thread of its own. Yields (action,
+        value) as each one comes out of the last stage. If any stage
+        (or the source) raises, everything stops and the exception
+        is re-raised here."""
+        queues = [Queue.Queue(self.depth) for stage in self.stages]
+        queues.append(Queue.Queue(self.depth))
+        workers = [max(workers, 1) for name, func, workers in self.stages]
+
+        self.start(self.feed, source, queues[0], workers[0])
+        for i, (name, func, count) in enumerate(self.stages):
+            consumers = workers[i + 1] if i + 1 < len(workers) else 1
+            remaining = [workers[i]]
+            for j in range(workers[i]):
+                self.start(self.work, name, func, queues[i], queues[i + 1],
+                           remaining, consumers)
+
+        try:
+            while True:
+                pair = self.get(queues[-1])
+                if pair is DONE:
+                    break
+                yield pair
+            if self.exc_info:
+                raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        finally:
+            self.cancelled = True
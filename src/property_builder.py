@@ -6,10 +6,27 @@ Ex.
 import property_builder as p
 class Section(object):
     title = p.text(p.find('div', 'title'))
+
+Every function here remembers its answer for each object, so asking
+for a property twice doesn't search the tree twice.
 """
 
+def memoize(func):
+    """Cache func(self) on self.
+
+    Works as a decorator for methods that only depend on self.node."""
+    def wrapper(self):
+        memo = self.__dict__.setdefault('_memo', {})
+        if wrapper not in memo:
+            memo[wrapper] = func(self)
+        return memo[wrapper]
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
 def find(*args, **kwargs):
     optional = kwargs.pop('optional', False)
+    @memoize
     def wrapper(self):
         node = self.node.find(*args, **kwargs)
         if not optional and not node:
@@ -19,11 +36,13 @@ def find(*args, **kwargs):
     return wrapper
 
 def text(element):
+    @memoize
     def wrapper(self):
         return element(self).text.strip()
     return wrapper
 
 def attr(name, element, strip_hash=False):
+    @memoize
     def wrapper(self):
         node = element(self)
         if not node: return node
@@ -34,6 +53,7 @@ def attr(name, element, strip_hash=False):
     return wrapper
 
 def exists(element):
+    @memoize
     def wrapper(self):
         return bool(element(self))
     return wrapper
@@ -0,0 +1,110 @@
+"""
+Making changes to the repository on behalf of actions.
+"""
+
+import os
+from src import instrument
+from src.annex import encode
+
+class Transaction(object):
+    """Performs the repository side of actions, committing each
+    action as soon as it's done.
+
+    Everything goes through an annex.AnnexSession, so that we aren't
+    starting a git process per file. Directories are relative to the
+    top of the annex, and filenames relative to their directory."""
+
+    def __init__(self, session):
+        self.session = session
+        # Whether anything's been staged since the last commit.
+        self.pending = False
+
+    def annex_add(self, target_dir, filenames):
+        if not filenames:
+            # Nothing new (an unpack that only found copies of what
+            # was already there, say). Adding the whole directory
+            # could pick up files other actions are still writing.
+            return
+        self.session.add([os.path.join(target_dir, filename)
+                          for filename in filenames])
+        self.pending = True
+
+    def annex_drop(self, target_dir, filename):
+        self.session.drop([os.path.join(target_dir, filename)])
+
+    def move(self, target_dir, old_filename, new_filename):
+        self.session.move(os.path.join(target_dir, old_filename),
+                          os.path.join(target_dir, new_filename))
+        self.pending = True
+
+    def remove(self, target_dir, filename):
+        self.session.remove(os.path.join(target_dir, filename))
+        self.pending = True
+
+    def commit(self, target_dir, message):
+        """Note that the action described by message is finished."""
+        if not self.pending:
+            print "Nothing new to commit for: {}".format(message)
+            return
+        self.session.sync()
+        instrument.check_call(['git', 'commit', '-m', message, '--',
+                               encode(target_dir)])
+        self.pending = False
+
+    def finish(self):
+        """Called once all the actions have been performed."""
+        pass
+
+    def close(self):
+        """Called at the end of the run, whether it worked or not."""
+        pass
+
+class BatchedTransaction(Transaction):
+    """Groups the changes from several actions into one commit.
+
+    A commit summarizing everything is made every commit_every
+    actions (or only at the end, if that's 0)."""
+
+    def __init__(self, session, commit_every):
+        super(BatchedTransaction, self).__init__(session)
+        self.commit_every = commit_every
+        self.messages = []
+        self.dirs = []
+
+    def commit(self, target_dir, message):
+        self.messages.append(message)
+        if target_dir not in self.dirs:
+            self.dirs.append(target_dir)
+        if self.commit_every and len(self.messages) >= self.commit_every:
+            self.flush()
+
+    def flush(self):
+        if not self.messages:
+            return
+        if not self.pending:
+            print "Nothing new to commit for:"
+            print "\n".join("  {}".format(line) for line in self.messages)
+            self.messages = []
+            self.dirs = []
+            return
+
+        self.session.sync()
+        if len(self.messages) == 1:
+            message = self.messages[0]
+        else:
+            message = "Humbug: {} actions\n\n{}".format(
+                len(self.messages),
+                "\n".join("- {}".format(line) for line in self.messages))
+        instrument.check_call(['git', 'commit', '-m', message, '--'] +
+                              [encode(dir) for dir in self.dirs])
+        self.messages = []
+        self.dirs = []
+        self.pending = False
+
+    def finish(self):
+        self.flush()
+
+    def close(self):
+        if self.messages:
+            print "These actions were performed but not committed:"
+            print "\n".join("  {}".format(line) for line in self.messages)
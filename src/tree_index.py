@@ -0,0 +1,89 @@
+"""
+A snapshot of the parts of the annex humbug looks at.
+"""
+
+import os
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+def list_entries(path):
+    """Return [(name, is_dir)] for path, in os.listdir order.
+
+    Symlinks (like annexed files) never count as directories."""
+    if scandir:
+        return [(entry.name, entry.is_dir(follow_symlinks=False))
+                for entry in scandir(path)]
+    entries = []
+    for name in os.listdir(path):
+        full_path = os.path.join(path, name)
+        entries.append((name, os.path.isdir(full_path) and
+                        not os.path.islink(full_path)))
+    return entries
+
+class TreeIndex(object):
+    """Lists every directory under some roots in a single traversal,
+    and answers listing and existence queries from memory.
+
+    Directories outside the roots are looked up on disk as usual. If
+    eager is False, nothing is scanned up front and each directory is
+    listed (once) the first time it's asked about, which is cheaper
+    when only a few directories are going to be looked at."""
+    def __init__(self, roots, eager=True):
+        self.roots = [os.path.normpath(root) for root in roots]
+        self.eager = eager
+        # dir -> [names], in the order os.listdir would give them, or
+        # None if it doesn't exist
+        self.listings = {}
+        # dir -> set(names)
+        self.names = {}
+        if eager:
+            for root in self.roots:
+                self.scan(root)
+
+    def scan(self, root):
+        # Use unicode so that names come back as unicode, the way
+        # os.listdir(target_dir) gives them for our unicode paths.
+        todo = [unicode(root)]
+        while todo:
+            path = todo.pop()
+            try:
+                entries = list_entries(path)
+            except OSError:
+                continue
+            self.listings[path] = [name for name, is_dir in entries]
+            todo.extend(os.path.join(path, name)
+                        for name, is_dir in entries if is_dir)
+
+    def covers(self, path):
+        return any(path == root or path.startswith(root + os.sep)
+                   for root in self.roots)
+
+    def listdir(self, dir):
+        """Return a list of names in dir, or None if there's no such directory."""
+        dir = os.path.normpath(dir)
+        if not self.covers(dir):
+            if not os.path.isdir(dir):
+                return None
+            return os.listdir(dir)
+        if not self.eager and dir not in self.listings:
+            try:
+                self.listings[dir] = [name for name, is_dir in list_entries(dir)]
+            except OSError:
+                self.listings[dir] = None
+        listing = self.listings.get(dir)
+        if listing is None:
+            return None
+        return list(listing)
+
+    def lexists(self, path):
+        """Like os.path.lexists."""
+        path = os.path.normpath(path)
+        dir, name = os.path.split(path)
+        if not self.covers(dir):
+            return os.path.lexists(path)
+        if dir not in self.names:
+            self.names[dir] = set(self.listdir(dir) or [])
+        return name in self.names[dir]
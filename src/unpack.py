@@ -0,0 +1,216 @@
+"""
+Unpacking zips and tarballs straight into the annex.
+"""
+
+import os
+import stat
+import time
+import shutil
+import tempfile
+import hashlib
+import contextlib
+import tarfile
+import zipfile
+from src import utils
+from src import instrument
+
+CHUNKSIZE = 1024*1024
+
+class Member(object):
+    """One file in an archive: its name, permissions, and a way to read it."""
+    def __init__(self, name, mode, open, is_dir=False, linkname=None):
+        self.name = name
+        self.mode = mode
+        self.open = open
+        self.is_dir = is_dir
+        self.linkname = linkname
+
+def zip_members(archive):
+    for info in archive.infolist():
+        # Unix permissions live in the top half of external_attr, if
+        # whoever made the zip bothered.
+        unix_mode = info.external_attr >> 16
+        if stat.S_ISLNK(unix_mode):
+            # The link target is stored as the contents.
+            yield Member(info.filename, 0, None, linkname=archive.read(info))
+            continue
+        yield Member(info.filename, unix_mode & 0777,
+                     lambda info=info: archive.open(info),
+                     is_dir=info.filename.endswith('/'))
+
+def tar_members(archive):
+    # Iterating over a tarfile reads it front to back, so this works
+    # for compressed ones too.
+    for info in archive:
+        if info.isdir():
+            yield Member(info.name, info.mode, None, is_dir=True)
+        elif info.issym():
+            yield Member(info.name, info.mode, None, linkname=info.linkname)
+        elif info.isfile():
+            yield Member(info.name, info.mode,
+                         lambda info=info: archive.extractfile(info))
+        else:
+            print "Not unpacking {} (not a regular file)".format(info.name)
+
+def open_archive(filename):
+    """Return (archive, members), or None if we can't read this kind of file."""
+    if zipfile.is_zipfile(filename):
+        archive = zipfile.ZipFile(filename)
+        return archive, zip_members(archive)
+    if tarfile.is_tarfile(filename):
+        # Streaming mode, so that each member is read straight after
+        # its header, without seeking back and forth in a .tar.gz.
+        archive = tarfile.open(filename, 'r|*')
+        return archive, tar_members(archive)
+    return None
+
+def safe_path(name):
+    """The path to unpack name to, relative to the target directory,
+    or None if it would end up outside it."""
+    path = os.path.normpath(name)
+    if os.path.isabs(path) or path == '..' or path.startswith('../') or path == '.':
+        return None
+    return path
+
+def lone_directory(names):
+    """If everything in the archive is inside one top-level
+    directory, return its name.
+
+    aunpack would move that directory's contents up into the target
+    directory, so we leave it out too."""
+    paths = [path for path in map(safe_path, names) if path is not None]
+    tops = set(path.split('/')[0] for path in paths)
+    if len(tops) != 1:
+        return None
+    top = tops.pop()
+    if not any(path != top for path in paths):
+        # Just the one file (or an empty directory).
+        return None
+    return top
+
+def is_inside(path, root):
+    """Is path (already resolved with realpath) root or under it?"""
+    return path == root or path.startswith(root.rstrip('/') + '/')
+
+def copy_and_hash(source, filename):
+    """Write everything from source to filename, returning its md5."""
+    hash = hashlib.md5()
+    size = 0
+    start = time.time()
+    with open(filename, 'wb') as f:
+        while True:
+            chunk = source.read(CHUNKSIZE)
+            if not chunk:
+                break
+            hash.update(chunk)
+            f.write(chunk)
+            size += len(chunk)
+    instrument.add_work('unpack', size, time.time() - start)
+    return hash.hexdigest()
+
+def unpack(filename, target_dir, existing_md5=utils.md5_file):
+    """Unpack the archive filename into target_dir, then delete it.
+
+    The archive is read once, front to back, with each file written
+    (and hashed) into a staging directory inside target_dir. Only
+    then do we know how the archive is laid out: if everything in it
+    is in one directory, its contents go straight into target_dir,
+    like aunpack did.
+
+    Each file is then moved into place. If something's already there,
+    the file is only kept if it's different, in which case it's left
+    beside the old one with '.unpacked' on the end.
+    existing_md5(path) is asked for the md5 of what's already there.
+
+    Returns the files (relative to target_dir) that are new, or None
+    if filename isn't a zip or a tarball."""
+    opened = open_archive(filename)
+    if opened is None:
+        return None
+    archive, members = opened
+
+    staging = tempfile.mkdtemp(prefix='.humbug-unpacking-', dir=target_dir)
+    try:
+        # [(member, staged filename, md5)], in the order they came
+        unpacked = []
+        with contextlib.closing(archive):
+            for member in members:
+                if member.is_dir or member.linkname is not None:
+                    unpacked.append((member, None, None))
+                    continue
+                # Numbered, so nothing in the archive can steer where
+                # these go.
+                staged = os.path.join(staging, str(len(unpacked)))
+                source = member.open()
+                try:
+                    md5 = copy_and_hash(source, staged)
+                finally:
+                    source.close()
+                if member.mode & 0111:
+                    os.chmod(staged, member.mode)
+                unpacked.append((member, staged, md5))
+
+        lone = lone_directory([member.name for member, staged, md5 in unpacked])
+        new_files = []
+        for member, staged, md5 in unpacked:
+            path = place(member, staged, md5, target_dir, lone, existing_md5)
+            if path:
+                new_files.append(path)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    os.unlink(filename)
+    return new_files
+
+def place(member, staged, md5, target_dir, lone, existing_md5):
+    """Move one unpacked member from staging to where it belongs.
+
+    Returns its path relative to target_dir if it's new there."""
+    path = safe_path(member.name)
+    if path is not None and lone:
+        if path == lone:
+            return None
+        path = path[len(lone) + 1:]
+    if path is None:
+        print "Not unpacking {} (outside {})".format(member.name, target_dir)
+        return None
+    target = os.path.join(target_dir, path)
+
+    # Make sure no symlink (from the archive or already there) takes
+    # us somewhere else.
+    root = os.path.realpath(target_dir)
+    parent = os.path.dirname(target)
+    if not is_inside(os.path.realpath(parent), root):
+        print "Not unpacking {} (outside {})".format(member.name, target_dir)
+        return None
+
+    if member.is_dir:
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        return None
+
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+
+    if member.linkname is not None:
+        pointee = os.path.realpath(os.path.join(parent, member.linkname))
+        if os.path.isabs(member.linkname) or not is_inside(pointee, root):
+            print "Not unpacking {} (links outside {})".format(
+                member.name, target_dir)
+            return None
+        if os.path.lexists(target):
+            return None
+        os.symlink(member.linkname, target)
+        return path
+
+    if not os.path.lexists(target):
+        os.rename(staged, target)
+        if utils.hash_cache:
+            utils.hash_cache.store(target, utils.hash_cache.signature(target), md5)
+        return path
+    if md5 == existing_md5(target):
+        return None
+    shutil.move(staged, target + '.unpacked')
+    print "Couldn't figure out what to do with unpacked file {}; left it in {}".format(
+        target, target + '.unpacked')
+    return None
@@ -1,13 +1,70 @@
+import io
+import os
+import time
+import mmap
 import hashlib
+import threading
+from src import instrument
 
-BLOCKSIZE = 50*1024*1024
-def md5_file(filename):
+# A hashcache.HashCache, if the application has set one up.
+hash_cache = None
+
+# How much of a file to hash at a time. Bigger than this doesn't get
+# any faster, it just uses more memory.
+BLOCKSIZE = 1024*1024
+# Files at least this big are hashed by mmapping them rather than
+# reading them into a buffer. None means never.
+MMAP_THRESHOLD = None
+
+# Each thread gets one buffer, which is reused for every file it hashes.
+_buffers = threading.local()
+
+def _buffer(size):
+    buf = getattr(_buffers, 'buffer', None)
+    if buf is None or len(buf) != size:
+        buf = _buffers.buffer = bytearray(size)
+    return buf
+
+def md5_and_size(filename, blocksize=None, mmap_threshold=None):
+    """Hash filename without holding more than one block of it in
+    memory at a time. Returns (md5, number of bytes)."""
+    blocksize = blocksize or BLOCKSIZE
+    if mmap_threshold is None:
+        mmap_threshold = MMAP_THRESHOLD
     hash = hashlib.md5()
-    f = file(filename)
-    while True:
-        s = f.read(BLOCKSIZE)
-        if s == '':
-            break
-        hash.update(s)
-
-    return hash.hexdigest()
+    size = 0
+    # Unbuffered, so that readinto goes straight into our buffer.
+    with io.open(filename, 'rb', buffering=0) as f:
+        length = os.fstat(f.fileno()).st_size
+        if mmap_threshold is not None and length and length >= mmap_threshold:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for start in xrange(0, len(mapped), blocksize):
+                    hash.update(buffer(mapped, start, blocksize))
+                size = len(mapped)
+            finally:
+                mapped.close()
+        else:
+            buf = _buffer(blocksize)
+            view = memoryview(buf)
+            while True:
+                read = f.readinto(buf)
+                if not read:
+                    break
+                size += read
+                hash.update(view[:read])
+    return hash.hexdigest(), size
+
+def md5_file(filename):
+    if hash_cache:
+        signature, cached = hash_cache.lookup(filename)
+        if cached:
+            return cached
+
+    start = time.time()
+    digest, size = md5_and_size(filename)
+    instrument.add_work('hash', size, time.time() - start)
+
+    if hash_cache:
+        hash_cache.store(filename, signature, digest)
+    return digest
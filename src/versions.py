@@ -2,12 +2,42 @@
 Kinds of version numbers we find in Humble filenames.
 """
 
+import bisect
+
 class VersionNumber(object):
+    """A version number of some kind.
+
+    Version numbers only compare with version numbers of exactly the
+    same type; any comparison with a different type is false."""
     def __init__(self, verno):
         self.raw_version = verno
 
+    def comparable(self, rhs):
+        return type(self) == type(rhs)
+
+    def __eq__(self, rhs):
+        return self.comparable(rhs) and self.raw_version == rhs.raw_version
+
+    def __ne__(self, rhs):
+        return not self == rhs
+
     def __lt__(self, rhs):
-        return type(self) == type(rhs) and self.raw_version < rhs.raw_version
+        return self.comparable(rhs) and self.raw_version < rhs.raw_version
+
+    def __le__(self, rhs):
+        return self.comparable(rhs) and self.raw_version <= rhs.raw_version
+
+    def __gt__(self, rhs):
+        return self.comparable(rhs) and self.raw_version > rhs.raw_version
+
+    def __ge__(self, rhs):
+        return self.comparable(rhs) and self.raw_version >= rhs.raw_version
+
+    def __hash__(self):
+        return hash((type(self), self.raw_version))
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.raw_version)
 
 class Timestamp(VersionNumber):
     pass
@@ -27,4 +57,82 @@ class BackwardsDateString(DateString):
 
 class DebianVersion(VersionNumber):
     """Something like 1.6.1-3"""
-    pass
+    def __init__(self, verno):
+        # Tuples compare like lists, but can be hashed.
+        super(DebianVersion, self).__init__(tuple(verno))
+
+class VersionIndex(object):
+    """The version numbers of the files in one directory.
+
+    parse(filename) should return a list of possible version numbers
+    for the file, most canonical first, ending with the name-ish first
+    part of the filename (like GameHandler.get_version_number). Each
+    file is parsed once, when it's added.
+
+    Files are grouped by that first part and kept sorted by version,
+    so finding the newest copy of something or everything older than
+    a version is a lookup."""
+    def __init__(self, parse):
+        self.parse = parse
+        # filename -> {type: lowest version of that type in filename}
+        self.lowest = {}
+        # (title, type) -> sorted [(version, filename)]
+        self.by_title = {}
+        # filename -> (title, type of its most canonical version)
+        self.canonical = {}
+
+    def add(self, filename):
+        if filename in self.lowest:
+            return
+        versions = self.parse(filename)
+        title = versions[-1]
+        lowest = {}
+        for version in versions:
+            kind = type(version)
+            if kind not in lowest or version < lowest[kind]:
+                lowest[kind] = version
+        self.lowest[filename] = lowest
+        self.canonical[filename] = (title, type(versions[0]))
+        for kind, version in lowest.iteritems():
+            bisect.insort(self.by_title.setdefault((title, kind), []),
+                          (version, filename))
+
+    def has_older(self, filename, version):
+        """Does filename have a version of the same type as version,
+        but lower?"""
+        self.add(filename)
+        lowest = self.lowest[filename].get(type(version))
+        return lowest is not None and version > lowest
+
+    def newest(self, title, kind):
+        """Return (version, filename) for the newest file called
+        title with a version of type kind, or None."""
+        files = self.by_title.get((title, kind))
+        return files[-1] if files else None
+
+    def older_than(self, title, version):
+        """Return [(version, filename)] for every file called title
+        that's older than version."""
+        files = self.by_title.get((title, type(version)), [])
+        return files[:bisect.bisect_left(files, (version,))]
+
+    def newest_first(self, filenames):
+        """Return filenames with the files of each title in order of
+        version, newest first.
+
+        Only the order within a title changes; each title keeps the
+        places its files had."""
+        for filename in filenames:
+            self.add(filename)
+        wanted = set(filenames)
+        # (title, type) -> its files in filenames, newest first
+        ordered = {}
+        result = []
+        for filename in filenames:
+            group = self.canonical[filename]
+            if group not in ordered:
+                ordered[group] = [name for version, name
+                                  in reversed(self.by_title[group])
+                                  if name in wanted and self.canonical[name] == group]
+            result.append(ordered[group].pop(0))
+        return result
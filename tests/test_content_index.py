@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+import unittest
+from src.content_index import ContentIndex
+
+class Keys(object):
+    """Stands in for annex.KeyLookup: every file's md5 is its content."""
+    def __init__(self):
+        self.looked_up = []
+
+    def prefetch(self, paths):
+        self.looked_up.extend(paths)
+
+    def md5(self, path):
+        with open(path) as f:
+            return f.read()
+
+class ContentIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.annex = tempfile.mkdtemp()
+        os.chdir(self.annex)
+        for path, content in [('Games/Alpha/Linux/alpha.deb', 'alpha'),
+                              ('Games/Alpha/Soundtrack/ost.zip', 'ost'),
+                              ('Games/Beta/Linux/beta.deb', 'beta'),
+                              ('Music/Album/ost.zip', 'ost'),
+                              ('Other/notes.txt', 'notes')]:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(content)
+        self.keys = Keys()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.annex)
+
+    def index(self, everywhere=True):
+        return ContentIndex(self.keys, ['Games/', 'Music/'], everywhere)
+
+    def walked(self):
+        return set(path.split(os.sep)[1] for path in self.keys.looked_up)
+
+    def test_nearby_first(self):
+        index = self.index()
+        self.assertEqual(index.find('ost', exclude_dir=u'Games/Alpha/Windows'),
+                         u'Games/Alpha/Soundtrack/ost.zip')
+        self.assertEqual(self.walked(), set(['Alpha']))
+
+    def test_everywhere(self):
+        index = self.index()
+        self.assertEqual(index.find('beta', exclude_dir=u'Games/Alpha/Linux'),
+                         u'Games/Beta/Linux/beta.deb')
+        self.assertEqual(index.find('notes', exclude_dir=u'Games/Alpha/Linux'),
+                         u'Other/notes.txt')
+        self.assertEqual(index.find('nothing', exclude_dir=u'Games/Alpha/Linux'), None)
+
+    def test_exclude_dir(self):
+        index = self.index()
+        self.assertEqual(index.find('alpha', exclude_dir=u'Games/Alpha/Linux'), None)
+
+    def test_scoped(self):
+        index = self.index(everywhere=False)
+        self.assertEqual(index.find('beta', exclude_dir=u'Games/Alpha/Linux'), None)
+        self.assertEqual(self.walked(), set(['Alpha']))
+        # Once Beta has been looked at, its files count too.
+        index.find('nothing', exclude_dir=u'Games/Beta/Windows')
+        self.assertEqual(index.find('beta', exclude_dir=u'Games/Alpha/Linux'),
+                         u'Games/Beta/Linux/beta.deb')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+from src.handlers import HandlerTable, GameHandler, MovieHandler, BookHandler, AlbumHandler
+
+class Item(object):
+    def __init__(self, title='Something', has_book=False, has_game=False,
+                 has_soundtrack=False, is_comedy=False):
+        self.title = title
+        self.has_book = has_book
+        self.has_game = has_game
+        self.has_soundtrack = has_soundtrack
+        self.is_comedy = is_comedy
+
+class HandlerTableTest(unittest.TestCase):
+    def test_builtin_rules(self):
+        table = HandlerTable()
+        self.assertEqual(table.handler_for(Item(has_game=True)), GameHandler)
+        self.assertEqual(table.handler_for(Item(has_book=True)), BookHandler)
+        self.assertEqual(table.handler_for(Item(has_book=True, has_game=True)),
+                         GameHandler)
+        self.assertEqual(table.handler_for(Item(is_comedy=True)), MovieHandler)
+        self.assertEqual(table.handler_for(Item('Indie Game: The Movie',
+                                                has_soundtrack=True)),
+                         MovieHandler)
+        self.assertEqual(table.handler_for(Item(has_soundtrack=True)), None)
+
+    def test_added_rule_wins(self):
+        table = HandlerTable()
+        soundtrack = Item(has_soundtrack=True)
+        self.assertEqual(table.handler_for(soundtrack), None)
+        table.add(AlbumHandler, kinds=['soundtrack'], excluded=['game'])
+        self.assertEqual(table.handler_for(soundtrack), AlbumHandler)
+        # Games with soundtracks are left alone.
+        self.assertEqual(table.handler_for(Item(has_game=True, has_soundtrack=True)),
+                         GameHandler)
+
+    def test_added_title_rule_wins(self):
+        table = HandlerTable()
+        table.add(AlbumHandler, titles=['Indie Game: The Soundtrack'])
+        self.assertEqual(table.handler_for(Item('Indie Game: The Soundtrack',
+                                                has_soundtrack=True)),
+                         AlbumHandler)
+        # The broader 'Indie Game*' rule still applies to everything else.
+        self.assertEqual(table.handler_for(Item('Indie Game: The Movie')),
+                         MovieHandler)
+
+    def test_added_rules_keep_their_order(self):
+        table = HandlerTable()
+        table.add(AlbumHandler, kinds=['soundtrack'])
+        table.add(BookHandler, kinds=['soundtrack'])
+        self.assertEqual(table.handler_for(Item(has_soundtrack=True)), AlbumHandler)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from src.humble_orders import OrderData
+
+def struct(name, filename, md5=None, file_size=10):
+    data = {'name': name, 'file_size': file_size, 'human_size': '10 bytes',
+            'url': {'web': 'https://dl.humble.com/{}?key=abc'.format(filename)}}
+    if md5:
+        data['md5'] = md5
+    return data
+
+class OrderDataTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='humbug-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read(self, order):
+        filename = os.path.join(self.tmpdir, 'order.json')
+        with open(filename, 'w') as f:
+            json.dump(order, f)
+        return OrderData(filename)
+
+    def test_download_without_md5_is_skipped(self):
+        page = self.read({
+            'product': {'human_name': 'Test Bundle'},
+            'subproducts': [{
+                'human_name': 'Game',
+                'payee': {'human_name': 'Dev'},
+                'downloads': [{'platform': 'linux', 'download_struct': [
+                    struct('.deb', 'game.deb', md5='0' * 32),
+                    struct('.rpm', 'game.rpm')]}]}]})
+        [item] = page.iteritems()
+        self.assertTrue(item.has_game)
+        [dl] = item.downloads()
+        self.assertEqual(dl.filename, 'game.deb')
+        self.assertEqual(dl.md5, '0' * 32)
+        self.assertEqual(dl.size_range, (10, 10))
+
+    def test_fields(self):
+        page = self.read([{
+            'product': {'human_name': 'Test Bundle'},
+            'subproducts': [{
+                'human_name': 'Book',
+                'payee': {'human_name': 'Author'},
+                'downloads': [{'platform': 'ebook', 'download_struct': [
+                    struct('PDF', 'book.pdf', md5='1' * 32)]}]}]}])
+        self.assertEqual(page.title, 'Test Bundle')
+        [item] = page.iteritems()
+        self.assertEqual((item.title, item.subtitle), ('Book', 'Author'))
+        self.assertTrue(item.has_book)
+        self.assertFalse(item.has_game)
+        [dl] = item.downloads()
+        self.assertEqual((dl.type, dl.arch, dl.is_file), ('ebook', '32-bit', True))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import os
+import shutil
+import tarfile
+import zipfile
+import tempfile
+import unittest
+from StringIO import StringIO
+from src import unpack
+
+class UnpackTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = os.path.realpath(tempfile.mkdtemp(prefix='humbug-test-'))
+        self.target_dir = os.path.join(self.tmpdir, 'target')
+        os.mkdir(self.target_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_zip(self, files):
+        filename = os.path.join(self.target_dir, 'archive.zip')
+        with zipfile.ZipFile(filename, 'w') as archive:
+            for name, contents in files:
+                archive.writestr(name, contents)
+        return filename
+
+    def make_tar(self, members):
+        """members is [(name, contents)], (name, None, linkname) for a
+        symlink, or (name, None, None) for a directory."""
+        filename = os.path.join(self.target_dir, 'archive.tar')
+        with tarfile.open(filename, 'w') as archive:
+            for member in members:
+                info = tarfile.TarInfo(member[0])
+                if member[1] is None and member[2] is None:
+                    info.type = tarfile.DIRTYPE
+                    archive.addfile(info)
+                elif member[1] is None:
+                    info.type = tarfile.SYMTYPE
+                    info.linkname = member[2]
+                    archive.addfile(info)
+                else:
+                    info.size = len(member[1])
+                    archive.addfile(info, StringIO(member[1]))
+        return filename
+
+    def test_lone_directory_is_stripped(self):
+        filename = self.make_zip([
+            ('Indie Game The Movie/indiegamethemovie_720p.mp4', 'movie')])
+        new_files = unpack.unpack(filename, self.target_dir)
+        self.assertEqual(new_files, ['indiegamethemovie_720p.mp4'])
+        self.assertEqual(
+            sorted(os.listdir(self.target_dir)), ['indiegamethemovie_720p.mp4'])
+
+    def test_lone_directory_in_tarball(self):
+        filename = self.make_tar([('Game/', None, None), ('Game/bin/game', 'game'),
+                                  ('Game/README', 'read me')])
+        opened = []
+        real_open = tarfile.open
+        def counting_open(name=None, mode='r', *args, **kwargs):
+            if mode == 'r|*':
+                opened.append(name)
+            return real_open(name, mode, *args, **kwargs)
+        tarfile.open = counting_open
+        try:
+            new_files = unpack.unpack(filename, self.target_dir)
+        finally:
+            tarfile.open = real_open
+        self.assertEqual(sorted(new_files), ['README', 'bin/game'])
+        self.assertEqual(sorted(os.listdir(self.target_dir)), ['README', 'bin'])
+        # Read through once, not once to look and again to unpack.
+        self.assertEqual(len(opened), 1)
+
+    def test_several_top_level_entries_are_kept(self):
+        filename = self.make_zip([('a/one', '1'), ('two', '2')])
+        new_files = unpack.unpack(filename, self.target_dir)
+        self.assertEqual(sorted(new_files), ['a/one', 'two'])
+
+    def test_lone_file(self):
+        filename = self.make_zip([('movie.mp4', 'movie')])
+        self.assertEqual(unpack.unpack(filename, self.target_dir), ['movie.mp4'])
+
+    def test_symlink_out_of_target_dir(self):
+        outside = os.path.join(self.tmpdir, 'outside')
+        os.mkdir(outside)
+        filename = self.make_tar([
+            ('link', None, outside),
+            ('link/pwned', 'gotcha'),
+            ('relative', None, '../outside'),
+            ('relative/pwned', 'gotcha'),
+            ('fine', 'fine')])
+        new_files = unpack.unpack(filename, self.target_dir)
+        # Without the links, the files just end up in directories.
+        self.assertEqual(new_files, ['link/pwned', 'relative/pwned', 'fine'])
+        self.assertEqual(os.listdir(outside), [])
+        self.assertFalse(os.path.islink(os.path.join(self.target_dir, 'link')))
+        self.assertFalse(os.path.islink(os.path.join(self.target_dir, 'relative')))
+
+    def test_write_through_existing_symlink(self):
+        outside = os.path.join(self.tmpdir, 'outside')
+        os.mkdir(outside)
+        os.symlink(outside, os.path.join(self.target_dir, 'link'))
+        filename = self.make_tar([('link/pwned', 'gotcha'), ('fine', 'fine')])
+        self.assertEqual(unpack.unpack(filename, self.target_dir), ['fine'])
+        self.assertEqual(os.listdir(outside), [])
+
+    def test_symlink_inside_target_dir(self):
+        filename = self.make_tar([('real', 'contents'), ('link', None, 'real'),
+                                  ('other', 'x')])
+        new_files = unpack.unpack(filename, self.target_dir)
+        self.assertEqual(sorted(new_files), ['link', 'other', 'real'])
+        self.assertEqual(os.readlink(os.path.join(self.target_dir, 'link')), 'real')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import unittest
+from src.versions import VersionIndex, DebianVersion
+
+def parse(filename):
+    # name-1.2.tar.gz -> [DebianVersion([1, 2]), 'name']
+    name, version = filename.split('.tar')[0].split('-')
+    return [DebianVersion([int(part) for part in version.split('.')]), name]
+
+class VersionIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = VersionIndex(parse)
+        for filename in ['game-1.0.tar.gz', 'game-1.10.tar.gz',
+                         'game-1.2.tar.gz', 'other-3.0.tar.gz']:
+            self.index.add(filename)
+
+    def test_newest(self):
+        self.assertEqual(self.index.newest('game', DebianVersion)[1],
+                         'game-1.10.tar.gz')
+        self.assertEqual(self.index.newest('missing', DebianVersion), None)
+
+    def test_older_than(self):
+        older = self.index.older_than('game', DebianVersion([1, 10]))
+        self.assertEqual([filename for version, filename in older],
+                         ['game-1.0.tar.gz', 'game-1.2.tar.gz'])
+
+    def test_newest_first(self):
+        self.assertEqual(
+            self.index.newest_first(['game-1.0.tar.gz', 'other-3.0.tar.gz',
+                                     'game-1.10.tar.gz', 'game-1.2.tar.gz']),
+            ['game-1.10.tar.gz', 'other-3.0.tar.gz',
+             'game-1.2.tar.gz', 'game-1.0.tar.gz'])
+
+    def test_newest_first_only_reorders_what_it_is_given(self):
+        self.assertEqual(
+            self.index.newest_first(['game-1.0.tar.gz', 'game-1.2.tar.gz']),
+            ['game-1.2.tar.gz', 'game-1.0.tar.gz'])
+
+if __name__ == '__main__':
+    unittest.main()